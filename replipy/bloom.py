@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2013 Alexander Shorin
+# All rights reserved.
+#
+# This software is licensed as described in the file LICENSE, which
+# you should have received as part of this distribution.
+#
+
+import math
+
+
+class BloomFilter(object):
+    """Probabilistic set which answers either "definitely missed" or
+    "probably exists" for any hashable key.
+
+    Keys are hashed with builtin :func:`hash`, so filter is valid only
+    within the process which built it and have to be rebuilt on start.
+
+    :param capacity: expected number of keys
+    :param error_rate: false positive probability at full capacity
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(int(capacity), 1)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2)), 8)
+        self.hashes = max(int(round(self.size / capacity * math.log(2))), 1)
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        # double hashing: k positions out of two independent hashes
+        first = hash(key)
+        second = hash((key, self.size)) | 1
+        for num in range(self.hashes):
+            yield (first + num * second) % self.size
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        for pos in self._positions(key):
+            if not self._bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def is_full(self):
+        return self.count >= self.capacity
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2013 Alexander Shorin
+# All rights reserved.
+#
+# This software is licensed as described in the file LICENSE, which
+# you should have received as part of this distribution.
+#
+
+"""Read replica mode: keeps local databases in sync with the leader peer.
+
+Follower tails leader's ``_changes`` feed, fetches missed revisions with
+``_bulk_get`` and applies them locally with ``new_edits=false``. Peer which
+is registered with `leader` option serves reads from local databases and
+rejects or forwards writes to the leader::
+
+    app.register_blueprint(replipy, db_cls=MemoryDatabase,
+                           leader='http://leader:5000', leader_writes='reject')
+    follow(app, 'db')
+"""
+
+import hashlib
+import json
+import threading
+import time
+try:
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError
+    from urllib.parse import quote
+except ImportError:  # pragma: no cover
+    from urllib2 import Request, urlopen, HTTPError
+    from urllib import quote
+from .storage import ABCDatabase
+
+
+def request(url, method='GET', body=None, headers=None, timeout=60):
+    """Makes HTTP request and returns status, headers and raw body of
+    the response"""
+    req = Request(url, body, headers or {})
+    req.get_method = lambda: method
+    try:
+        resp = urlopen(req, timeout=timeout)
+    except HTTPError as err:
+        resp = err
+    try:
+        return resp.getcode(), resp.info(), resp.read()
+    finally:
+        resp.close()
+
+
+def request_json(url, method='GET', data=None, timeout=60):
+    body = None if data is None else json.dumps(data).encode()
+    headers = {'Accept': 'application/json',
+               'Content-Type': 'application/json'}
+    code, _, body = request(url, method, body, headers, timeout)
+    data = json.loads(body.decode())
+    if code >= 400:
+        raise RuntimeError('%s %s failed: %s %s' % (
+            method, url, code, data.get('reason', data.get('error'))))
+    return data
+
+
+class Follower(threading.Thread):
+    """Keeps local database in sync with the leader one.
+
+    :param dbs: :class:`~replipy.storage.DatabaseManager` which provides
+                local database, ``app.dbs`` for instance
+    :param dbname: name of the database to follow
+    :param url: leader database URL
+    :param batch_size: number of changes to apply at once
+    :param interval: delay in seconds between polls of caught up feed
+    """
+
+    def __init__(self, dbs, dbname, url, batch_size=100, interval=1.0):
+        super(Follower, self).__init__()
+        self.daemon = True
+        self.dbs = dbs
+        self.dbname = dbname
+        self.url = url.rstrip('/')
+        self.batch_size = batch_size
+        self.interval = interval
+        self.leader_seq = None
+        self.doc_write_failures = 0
+        self.error = None
+        self._since = None
+        self._caught_up_at = time.time()
+        self._stop_event = threading.Event()
+
+    @property
+    def db(self):
+        return self.dbs[self.dbname]
+
+    @property
+    def checkpoint_id(self):
+        return '_local/follower-%s' % hashlib.md5(self.url.encode()).hexdigest()
+
+    @property
+    def since(self):
+        if self._since is None:
+            try:
+                self._since = self.db.load(self.checkpoint_id)['last_seq']
+            except ABCDatabase.NotFound:
+                self._since = 0
+        return self._since
+
+    def status(self):
+        """Returns replication lag in sequences and in seconds"""
+        since = self.since
+        if self.leader_seq is None or since >= self.leader_seq:
+            lag_seqs, lag_seconds = 0, 0
+        else:
+            lag_seqs = self.leader_seq - since
+            lag_seconds = time.time() - self._caught_up_at
+        return {
+            'leader': self.url,
+            'leader_seq': self.leader_seq,
+            'local_seq': since,
+            'lag_seqs': lag_seqs,
+            'lag_seconds': lag_seconds,
+            'doc_write_failures': self.doc_write_failures,
+            'error': None if self.error is None else str(self.error)
+        }
+
+    def fetch(self, missing):
+        """Returns missed revisions fetched from the leader. Revisions which
+        were updated in the meanwhile are resolved to their latest leafs"""
+        docs = []
+        items = [{'id': idx, 'rev': rev}
+                 for idx, info in missing.items() for rev in info['missing']]
+        if not items:
+            return docs
+        resp = request_json(self.url + '/_bulk_get?revs=true&attachments=true'
+                            '&latest=true', 'POST', {'docs': items})
+        for result in resp['results']:
+            for item in result['docs']:
+                if 'ok' in item:
+                    docs.append(item['ok'])
+        return docs
+
+    def step(self):
+        """Applies next batch of leader changes. Returns number of applied
+        changes"""
+        self.dbs.acquire(self.dbname)
+        try:
+            return self._step()
+        finally:
+            self.dbs.release(self.dbname)
+
+    def _step(self):
+        since = self.since
+        self.leader_seq = request_json(self.url + '/')['update_seq']
+        resp = request_json('%s/_changes?style=all_docs&since=%s&limit=%d' % (
+            self.url, quote(json.dumps(since)), self.batch_size))
+        changes = resp['results']
+        if not changes:
+            self._caught_up_at = time.time()
+            return 0
+
+        idrevs = {}
+        for change in changes:
+            revs = idrevs.setdefault(change['id'], [])
+            revs.extend(item['rev'] for item in change['changes'])
+        db = self.db
+        docs = self.fetch(db.revs_diff(idrevs))
+        failed = set()
+        if docs:
+            results = db.bulk_docs(docs, new_edits=False)
+            failed.update(result['id'] for result in results
+                          if 'error' in result)
+        self.doc_write_failures += len(failed)
+
+        last_seq = resp['last_seq']
+        if failed:
+            # checkpoint stops right before the first failed document, so
+            # it's retried on the next step
+            num = [change['id'] in failed for change in changes].index(True)
+            changes = changes[:num]
+            if not changes:
+                return 0
+            last_seq = changes[-1]['seq']
+        try:
+            checkpoint = dict(db.load(self.checkpoint_id))
+        except ABCDatabase.NotFound:
+            checkpoint = {'_id': self.checkpoint_id}
+        checkpoint['last_seq'] = last_seq
+        db.store(checkpoint)
+        self._since = last_seq
+        if last_seq >= self.leader_seq:
+            self._caught_up_at = time.time()
+        return len(changes)
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                applied = self.step()
+                self.error = None
+            except Exception as err:
+                self.error = err
+                applied = 0
+            if not applied:
+                self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+
+
+def follow(app, dbname, **options):
+    """Starts following leader's database with the same name. Local
+    database is created if it doesn't exists yet"""
+    try:
+        app.dbs.create(dbname)
+    except app.dbs.DatabaseExists:
+        pass
+    follower = Follower(app.dbs, dbname, '%s/%s' % (app.leader, dbname),
+                        **options)
+    app.followers[dbname] = follower
+    follower.start()
+    return follower
+
+
+def forward(url, method, body, headers):
+    """Forwards request to the leader and returns status, content type and
+    body of his response"""
+    code, info, body = request(url, method, body or None, headers)
+    return code, info.get('Content-Type', 'application/json'), body
@@ -0,0 +1,427 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2013 Alexander Shorin
+# All rights reserved.
+#
+# This software is licensed as described in the file LICENSE, which
+# you should have received as part of this distribution.
+#
+
+"""Load generator which replays CouchDB replicator traffic against
+locally started Replipy peer.
+
+Each simulated replicator pushes batches of documents into the peer the
+same way CouchDB does: reads replication log, asks ``_revs_diff`` for the
+batch, uploads missed revisions with ``_bulk_docs`` (``new_edits=false``)
+or, for documents with attachments, with multipart PUT, calls
+``_ensure_full_commit`` and writes checkpoint into ``_local`` document.
+
+Usage::
+
+    python -m replipy.loadtest --replicators 16 --batches 50 --json out.json
+
+Server runs in a separate process, so its RSS is measured without the
+load generator overhead.
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict
+try:
+    import http.client as httplib
+except ImportError:  # pragma: no cover
+    import httplib
+
+
+def percentile(values, pct):
+    """Returns pct percentile of the values using nearest rank method"""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(int(math.ceil(pct / 100.0 * len(values))) - 1, 0)
+    return values[rank]
+
+
+def read_rss(pid):
+    """Returns resident set size of the process in KiB or None if it
+    couldn't be obtained"""
+    try:
+        with open('/proc/%d/status' % pid) as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except (IOError, OSError, ValueError):
+        return None
+
+
+class Stats(object):
+    """Collects request latencies per endpoint"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latencies = defaultdict(list)
+        self._errors = defaultdict(int)
+
+    def record(self, endpoint, elapsed, ok=True):
+        with self._lock:
+            self._latencies[endpoint].append(elapsed)
+            if not ok:
+                self._errors[endpoint] += 1
+
+    def report(self, duration):
+        res = {}
+        for endpoint, latencies in sorted(self._latencies.items()):
+            res[endpoint] = {
+                'requests': len(latencies),
+                'errors': self._errors[endpoint],
+                'throughput': len(latencies) / duration if duration else None,
+                'p50_ms': percentile(latencies, 50) * 1000,
+                'p95_ms': percentile(latencies, 95) * 1000,
+                'p99_ms': percentile(latencies, 99) * 1000,
+                'max_ms': max(latencies) * 1000
+            }
+        return res
+
+
+class RSSSampler(threading.Thread):
+    """Samples server RSS with specified interval until stopped"""
+
+    def __init__(self, pid, interval=0.5):
+        super(RSSSampler, self).__init__()
+        self.daemon = True
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self._stop_event = threading.Event()
+        self._started_at = time.time()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            rss = read_rss(self.pid)
+            if rss is not None:
+                self.samples.append((round(time.time() - self._started_at, 3),
+                                     rss))
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+class Replicator(threading.Thread):
+    """Simulates single CouchDB replicator which pushes documents into
+    the peer"""
+
+    def __init__(self, num, host, port, dbname, stats, batches=10,
+                 batch_size=100, updates=0.2, attachments=0.05,
+                 attachment_size=64 * 1024, seed=None):
+        super(Replicator, self).__init__()
+        self.daemon = True
+        self.num = num
+        self.dbname = dbname
+        self.stats = stats
+        self.batches = batches
+        self.batch_size = batch_size
+        self.updates = updates
+        self.attachments = attachments
+        self.attachment_size = attachment_size
+        self.rep_id = '%s-%d' % (uuid.uuid4().hex, num)
+        self.error = None
+        self._conn = httplib.HTTPConnection(host, port)
+        self._random = random.Random(seed)
+        self._sent = []
+
+    def request(self, endpoint, method, path, body=None,
+                content_type='application/json', expect=(200, 201)):
+        headers = {'Content-Type': content_type,
+                   'Accept': 'application/json'}
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body)
+        started = time.time()
+        try:
+            self._conn.request(method, path, body, headers)
+            resp = self._conn.getresponse()
+            data = resp.read()
+        except (httplib.HTTPException, socket.error):
+            self._conn.close()
+            self.stats.record(endpoint, time.time() - started, False)
+            raise
+        self.stats.record(endpoint, time.time() - started,
+                          resp.status in expect)
+        if resp.getheader('Content-Type', '').startswith('application/json'):
+            return resp.status, json.loads(data.decode())
+        return resp.status, data
+
+    def make_rev(self, pos):
+        sig = hashlib.md5(str(self._random.random()).encode()).hexdigest()
+        return '%d-%s' % (pos, sig)
+
+    def make_batch(self):
+        docs = []
+        for _ in range(self.batch_size):
+            if self._sent and self._random.random() < self.updates:
+                idx, oldrev = self._sent.pop(
+                    self._random.randrange(len(self._sent)))
+                pos = int(oldrev.split('-', 1)[0]) + 1
+                rev = self.make_rev(pos)
+                revisions = {'start': pos,
+                             'ids': [rev.split('-', 1)[1],
+                                     oldrev.split('-', 1)[1]]}
+            else:
+                idx = uuid.uuid4().hex
+                rev = self.make_rev(1)
+                revisions = {'start': 1, 'ids': [rev.split('-', 1)[1]]}
+            docs.append({'_id': idx, '_rev': rev, '_revisions': revisions,
+                         'replicator': self.num,
+                         'value': self._random.random()})
+        return docs
+
+    def put_with_attachment(self, doc):
+        boundary = uuid.uuid4().hex
+        data = os.urandom(self.attachment_size)
+        doc = dict(doc, _attachments={'blob.bin': {
+            'content_type': 'application/octet-stream',
+            'length': len(data),
+            'follows': True
+        }})
+        body = b''.join([
+            b'--', boundary.encode(), b'\r\n',
+            b'Content-Type: application/json\r\n\r\n',
+            json.dumps(doc).encode(), b'\r\n',
+            b'--', boundary.encode(), b'\r\n',
+            b'Content-Disposition: attachment; filename="blob.bin"\r\n',
+            b'Content-Type: application/octet-stream\r\n',
+            ('Content-Length: %d\r\n\r\n' % len(data)).encode(),
+            data, b'\r\n',
+            b'--', boundary.encode(), b'--'])
+        self.request('put_multipart', 'PUT',
+                     '/%s/%s?new_edits=false' % (self.dbname, doc['_id']),
+                     body, 'multipart/related;boundary=%s' % boundary)
+
+    def replicate(self):
+        self.request('put_db', 'PUT', '/%s/' % self.dbname,
+                     expect=(201, 412))
+        logpath = '/%s/_local/%s' % (self.dbname, self.rep_id)
+        status, log = self.request('get_local', 'GET', logpath,
+                                   expect=(200, 404))
+        log = log if status == 200 else {'history': []}
+
+        for seq in range(1, self.batches + 1):
+            docs = self.make_batch()
+            _, missing = self.request(
+                'revs_diff', 'POST', '/%s/_revs_diff' % self.dbname,
+                dict((doc['_id'], [doc['_rev']]) for doc in docs))
+            docs = [doc for doc in docs if doc['_id'] in missing]
+
+            bulk = []
+            for doc in docs:
+                if self._random.random() < self.attachments:
+                    self.put_with_attachment(doc)
+                else:
+                    bulk.append(doc)
+            if bulk:
+                self.request('bulk_docs', 'POST',
+                             '/%s/_bulk_docs' % self.dbname,
+                             {'docs': bulk, 'new_edits': False})
+            self._sent.extend((doc['_id'], doc['_rev']) for doc in docs)
+
+            self.request('ensure_full_commit', 'POST',
+                         '/%s/_ensure_full_commit' % self.dbname)
+
+            log['source_last_seq'] = seq
+            log['history'] = [{'recorded_seq': seq,
+                               'docs_written': len(docs)}] + log['history'][:49]
+            _, resp = self.request('put_local', 'PUT', logpath, log)
+            log['_rev'] = resp['rev']
+
+    def run(self):
+        try:
+            self.replicate()
+        except Exception as err:
+            self.error = err
+        finally:
+            self._conn.close()
+
+
+def free_port(host):
+    sock = socket.socket()
+    try:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+def start_server(host, port, db_cls, threaded=True, max_open_dbs=None):
+    """Starts Replipy peer in separate process and waits until it's ready
+    to accept requests"""
+    args = [sys.executable, '-m', 'replipy.loadtest', '--serve',
+            '--host', host, '--port', str(port), '--db-cls', db_cls]
+    if not threaded:
+        args.append('--single-threaded')
+    if max_open_dbs is not None:
+        args.extend(['--max-open-dbs', str(max_open_dbs)])
+    proc = subprocess.Popen(args)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError('server exited with code %d' % proc.returncode)
+        try:
+            conn = httplib.HTTPConnection(host, port, timeout=1)
+            conn.request('GET', '/_all_dbs')
+            conn.getresponse().read()
+            conn.close()
+            return proc
+        except (httplib.HTTPException, socket.error):
+            time.sleep(0.1)
+    proc.terminate()
+    raise RuntimeError('server did not start in time')
+
+
+def serve(host, port, db_cls, threaded=True, max_open_dbs=None):
+    import flask
+    import werkzeug.serving
+    from .peer import replipy
+
+    modname, clsname = db_cls.split(':', 1)
+    module = __import__(modname, fromlist=[clsname])
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    app = flask.Flask(__name__)
+    app.register_blueprint(replipy, db_cls=getattr(module, clsname),
+                           max_open_dbs=max_open_dbs)
+    werkzeug.serving.run_simple(host, port, app, threaded=threaded)
+
+
+def run(replicators=4, dbs=1, batches=10, batch_size=100, updates=0.2,
+        attachments=0.05, attachment_size=64 * 1024, host='127.0.0.1',
+        port=None, db_cls='replipy.storage:MemoryDatabase', threaded=True,
+        max_open_dbs=None, rss_interval=0.5, seed=None):
+    """Runs load test against freshly started server and returns report.
+    Server listens on the specified port or on any free one if it's None"""
+    if port is None:
+        port = free_port(host)
+    proc = start_server(host, port, db_cls, threaded, max_open_dbs)
+    try:
+        stats = Stats()
+        sampler = RSSSampler(proc.pid, rss_interval)
+        workers = [Replicator(num, host, port, 'loadtest-%d' % (num % dbs),
+                              stats, batches, batch_size, updates,
+                              attachments, attachment_size,
+                              None if seed is None else seed + num)
+                   for num in range(replicators)]
+        sampler.start()
+        started = time.time()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        duration = time.time() - started
+        sampler.stop()
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    rss = [value for _, value in sampler.samples]
+    return {
+        'config': {
+            'replicators': replicators,
+            'dbs': dbs,
+            'batches': batches,
+            'batch_size': batch_size,
+            'updates': updates,
+            'attachments': attachments,
+            'attachment_size': attachment_size,
+            'port': port,
+            'db_cls': db_cls,
+            'threaded': threaded,
+            'max_open_dbs': max_open_dbs
+        },
+        'duration': duration,
+        'failed_replicators': [str(worker.error) for worker in workers
+                               if worker.error is not None],
+        'endpoints': stats.report(duration),
+        'rss_kb': {
+            'max': max(rss) if rss else None,
+            'last': rss[-1] if rss else None,
+            'samples': sampler.samples
+        }
+    }
+
+
+def format_report(report):
+    lines = ['%-20s %8s %6s %9s %9s %9s %9s %9s' % (
+        'endpoint', 'requests', 'errors', 'req/s',
+        'p50 ms', 'p95 ms', 'p99 ms', 'max ms')]
+    for endpoint, info in sorted(report['endpoints'].items()):
+        lines.append('%-20s %8d %6d %9.1f %9.2f %9.2f %9.2f %9.2f' % (
+            endpoint, info['requests'], info['errors'], info['throughput'],
+            info['p50_ms'], info['p95_ms'], info['p99_ms'], info['max_ms']))
+    lines.append('duration: %.2fs' % report['duration'])
+    lines.append('server rss: max %s KiB, last %s KiB' % (
+        report['rss_kb']['max'], report['rss_kb']['last']))
+    for error in report['failed_replicators']:
+        lines.append('replicator failed: %s' % error)
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m replipy.loadtest',
+        description='Replays CouchDB replication traffic against Replipy')
+    parser.add_argument('--replicators', type=int, default=4,
+                        help='number of concurrent replicators')
+    parser.add_argument('--dbs', type=int, default=1,
+                        help='number of target databases')
+    parser.add_argument('--batches', type=int, default=10,
+                        help='batches pushed by each replicator')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--updates', type=float, default=0.2,
+                        help='share of documents which are updates')
+    parser.add_argument('--attachments', type=float, default=0.05,
+                        help='share of documents uploaded with attachment')
+    parser.add_argument('--attachment-size', type=int, default=64 * 1024)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=None,
+                        help='server port, any free one by default')
+    parser.add_argument('--db-cls', default='replipy.storage:MemoryDatabase',
+                        help='storage backend as module:Class')
+    parser.add_argument('--single-threaded', action='store_true',
+                        help='run server without request threads')
+    parser.add_argument('--max-open-dbs', type=int, default=None)
+    parser.add_argument('--rss-interval', type=float, default=0.5)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--json', metavar='FILE',
+                        help='write report as JSON into the file')
+    parser.add_argument('--serve', action='store_true',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.serve:
+        if args.port is None:
+            parser.error('--port is required to serve')
+        return serve(args.host, args.port, args.db_cls,
+                     not args.single_threaded, args.max_open_dbs)
+
+    report = run(args.replicators, args.dbs, args.batches, args.batch_size,
+                 args.updates, args.attachments, args.attachment_size,
+                 args.host, args.port, args.db_cls, not args.single_threaded,
+                 args.max_open_dbs, args.rss_interval, args.seed)
+    print(format_report(report))
+    if args.json:
+        with open(args.json, 'w') as fobj:
+            json.dump(report, fobj, indent=2)
+
+
+if __name__ == '__main__':
+    main()
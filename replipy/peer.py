@@ -7,13 +7,16 @@
 # you should have received as part of this distribution.
 #
 
+import base64
 import functools
 import json
+import uuid
 import flask
 import werkzeug.exceptions
 import werkzeug.http
 from flask import current_app as app
-from .storage import ABCDatabase
+from .follower import forward
+from .storage import ABCDatabase, DatabaseManager
 
 
 replipy = flask.Blueprint('replipy', __name__)
@@ -37,16 +40,65 @@ def make_error_response(code, error, reason):
 def database_should_exists(func):
     @functools.wraps(func)
     def check_db(dbname, *args, **kwargs):
-        if dbname not in app.dbs:
+        try:
+            app.dbs.acquire(dbname)
+        except KeyError:
             return flask.abort(404, '%s missed' % dbname)
-        return func(dbname, *args, **kwargs)
+        # handle is kept open till the response is sent since streamed
+        # responses use it after the view returns
+        release = functools.partial(app.dbs.release, dbname)
+        try:
+            resp = flask.make_response(func(dbname, *args, **kwargs))
+        except Exception:
+            release()
+            raise
+        resp.call_on_close(release)
+        return resp
     return check_db
 
 
 @replipy.record_once
 def setup(state):
     state.app.db_cls = state.options.get('db_cls', ABCDatabase)
-    state.app.dbs = {}
+    db_options = state.options.get('db_options', {})
+    state.app.dbs = DatabaseManager(
+        functools.partial(state.app.db_cls, **db_options),
+        names=state.options.get('db_names', ()),
+        max_open=state.options.get('max_open_dbs'),
+        max_memory=state.options.get('max_dbs_memory'))
+    state.app.leader = state.options.get('leader')
+    state.app.leader_writes = state.options.get('leader_writes', 'reject')
+    state.app.followers = {}
+
+
+#: Endpoints which modify databases and are not served by follower
+WRITE_ENDPOINTS = frozenset([
+    'replipy.database',
+    'replipy.document',
+    'replipy.design_document',
+    'replipy.database_bulk_docs'
+])
+
+
+@replipy.before_request
+def guard_follower_writes():
+    if app.leader is None or flask.request.method in ('GET', 'HEAD'):
+        return
+    if flask.request.endpoint not in WRITE_ENDPOINTS:
+        return
+    if app.leader_writes == 'forward':
+        headers = dict((key, flask.request.headers[key])
+                       for key in ('Content-Type', 'Accept')
+                       if key in flask.request.headers)
+        code, ctype, body = forward(app.leader + flask.request.full_path,
+                                    flask.request.method,
+                                    flask.request.get_data(), headers)
+        resp = flask.make_response(body)
+        resp.status_code = code
+        resp.headers['Content-Type'] = ctype
+        return resp
+    return flask.abort(403, 'Writes should be made on the leader %s'
+                       % app.leader)
 
 
 @replipy.errorhandler(400)
@@ -54,6 +106,11 @@ def bad_request(err):
     return make_error_response(400, 'bad_request', err)
 
 
+@replipy.errorhandler(403)
+def forbidden(err):
+    return make_error_response(403, 'forbidden', err)
+
+
 @replipy.errorhandler(404)
 @replipy.errorhandler(ABCDatabase.NotFound)
 def not_found(err):
@@ -67,10 +124,38 @@ def conflict(err):
 
 
 @replipy.errorhandler(412)
+@replipy.errorhandler(DatabaseManager.DatabaseExists)
 def db_exists(err):
     return make_error_response(412, 'db_exists', err)
 
 
+@replipy.errorhandler(ABCDatabase.MissingStub)
+def missing_stub(err):
+    return make_error_response(412, 'missing_stub', err)
+
+
+@replipy.route('/_all_dbs', methods=['GET'])
+def all_dbs():
+    def generator(names):
+        yield '['
+        for idx, name in enumerate(names):
+            yield (idx and ',' or '') + json.dumps(name)
+        yield ']'
+
+    args = flask.request.args
+    try:
+        startkey = json.loads(args.get('startkey', 'null'))
+        endkey = json.loads(args.get('endkey', 'null'))
+        descending = json.loads(args.get('descending', 'false'))
+        limit = json.loads(args.get('limit', 'null'))
+        skip = json.loads(args.get('skip', '0'))
+    except ValueError as err:
+        return flask.abort(400, str(err))
+
+    names = app.dbs.all_dbs(startkey, endkey, limit, skip, descending)
+    return flask.Response(generator(names), content_type='application/json')
+
+
 @replipy.route('/<dbname>/', methods=['HEAD', 'GET', 'PUT'])
 def database(dbname):
     def head():
@@ -79,12 +164,13 @@ def database(dbname):
     def get():
         if dbname not in app.dbs:
             return flask.abort(404, '%s missed' % dbname)
-        return make_response(200, app.dbs[dbname].info())
+        info = app.dbs[dbname].info()
+        if dbname in app.followers:
+            info['follower'] = app.followers[dbname].status()
+        return make_response(200, info)
 
     def put():
-        if dbname in app.dbs:
-            return flask.abort(412, dbname)
-        app.dbs[dbname] = app.db_cls(dbname)
+        app.dbs.create(dbname)
         return make_response(201, {'ok': True})
 
     return locals()[flask.request.method.lower()]()
@@ -97,8 +183,38 @@ def document(dbname, docid):
         return get()
 
     def get():
-        doc = db.load(docid, flask.request.args.get('rev', None))
-        return make_response(200, doc)
+        args = flask.request.args
+        revs = json.loads(args.get('revs', 'false'))
+        latest = json.loads(args.get('latest', 'false'))
+        attachments = json.loads(args.get('attachments', 'false'))
+        atts_since = json.loads(args.get('atts_since', 'null'))
+
+        if 'open_revs' in args:
+            open_revs = args['open_revs']
+            open_revs = None if open_revs == 'all' else json.loads(open_revs)
+            results = db.open_revs(docid, open_revs, latest,
+                                   revs or bool(atts_since))
+            if accepts('multipart/mixed'):
+                return make_multipart_response(
+                    'multipart/mixed',
+                    (result_part(docid, result, attachments, revs, atts_since)
+                     for result in results))
+            return make_response(200, [
+                {'ok': render_doc(*with_atts_since(result['ok'], revs,
+                                                   atts_since),
+                                  attachments=attachments)}
+                if 'ok' in result else result
+                for result in results])
+
+        conflicts = json.loads(args.get('conflicts', 'false'))
+        doc = db.load(docid, args.get('rev', None), revs or bool(atts_since),
+                      conflicts)
+        doc, since = with_atts_since(doc, revs, atts_since)
+        if attachments and sent_attachments(doc, since) \
+                and accepts('multipart/related'):
+            return make_multipart_response(
+                'multipart/related', doc_parts(doc, since))
+        return make_response(200, render_doc(doc, since, attachments))
 
     def put():
         rev = flask.request.args.get('rev')
@@ -156,6 +272,42 @@ def local_document(dbname, docid):
     return document(dbname, '_local/' + docid)
 
 
+@replipy.route('/<dbname>/_all_docs', methods=['GET'])
+@database_should_exists
+def database_all_docs(dbname):
+    def generator(rows):
+        yield '{"offset":%d,"rows":[' % skip
+        num = 0
+        for batch in batches(rows):
+            if include_docs:
+                docs = db.load_many([idx for idx, _ in batch], conflicts)
+            for idx, rev in batch:
+                row = {'id': idx, 'key': idx, 'value': {'rev': rev}}
+                if include_docs:
+                    row['doc'] = render_doc(docs[idx])
+                yield (num and ',' or '') + json.dumps(row)
+                num += 1
+        yield ']}'
+
+    db = app.dbs[dbname]
+
+    args = flask.request.args
+    try:
+        startkey = json.loads(args.get('startkey', 'null'))
+        endkey = json.loads(args.get('endkey', 'null'))
+        limit = json.loads(args.get('limit', 'null'))
+        skip = json.loads(args.get('skip', '0'))
+        descending = json.loads(args.get('descending', 'false'))
+        include_docs = json.loads(args.get('include_docs', 'false'))
+        conflicts = json.loads(args.get('conflicts', 'false'))
+    except ValueError as err:
+        return flask.abort(400, str(err))
+    filter = args.get('filter', None)
+
+    rows = db.all_docs(startkey, endkey, limit, skip, descending, filter)
+    return flask.Response(generator(rows), content_type='application/json')
+
+
 @replipy.route('/<dbname>/_revs_diff', methods=['POST'])
 @database_should_exists
 def database_revs_diff(dbname):
@@ -163,6 +315,57 @@ def database_revs_diff(dbname):
     return make_response(200, db.revs_diff(flask.request.get_json()))
 
 
+@replipy.route('/<dbname>/_bulk_get', methods=['POST'])
+@database_should_exists
+def database_bulk_get(dbname):
+    def fetch(item):
+        idx, rev = item.get('id'), item.get('rev')
+        revisions = revs or bool(item.get('atts_since'))
+        try:
+            if rev is None:
+                return idx, [{'ok': db.load(idx, None, revisions)}]
+            return idx, db.open_revs(idx, [rev], latest, revisions)
+        except ABCDatabase.NotFound:
+            return idx, [{'missing': rev}]
+
+    def generator(docs):
+        yield '{"results":['
+        for num, item in enumerate(docs):
+            idx, results = fetch(item)
+            atts_since = item.get('atts_since')
+            yield (num and ',' or '') + json.dumps({
+                'id': idx,
+                'docs': [{'ok': render_doc(*with_atts_since(result['ok'], revs,
+                                                            atts_since),
+                                           attachments=attachments)}
+                         if 'ok' in result else
+                         {'error': missing_error(idx, result['missing'])}
+                         for result in results]
+            })
+        yield ']}'
+
+    def parts(docs):
+        for item in docs:
+            idx, results = fetch(item)
+            for result in results:
+                yield result_part(idx, result, attachments, revs,
+                                  item.get('atts_since'))
+
+    db = app.dbs[dbname]
+    args = flask.request.args
+    revs = json.loads(args.get('revs', 'false'))
+    latest = json.loads(args.get('latest', 'false'))
+    attachments = json.loads(args.get('attachments', 'false'))
+
+    docs = (flask.request.get_json() or {}).get('docs')
+    if not isinstance(docs, list):
+        return flask.abort(400, 'Missing JSON list of `docs`')
+
+    if accepts('multipart/mixed'):
+        return make_multipart_response('multipart/mixed', parts(docs))
+    return flask.Response(generator(docs), content_type='application/json')
+
+
 @replipy.route('/<dbname>/_bulk_docs', methods=['POST'])
 @database_should_exists
 def database_bulk_docs(dbname):
@@ -177,32 +380,64 @@ def database_ensure_full_commit(dbname):
     return make_response(201, db.ensure_full_commit())
 
 
+@replipy.route('/<dbname>/_compact', methods=['POST'])
+@database_should_exists
+def database_compact(dbname):
+    app.dbs[dbname].compact()
+    return make_response(202, {'ok': True})
+
+
 @replipy.route('/<dbname>/_changes', methods=['GET'])
 @database_should_exists
 def database_changes(dbname):
     def generator(changes, last_seq):
-        yield '{"last_seq": %d,' % last_seq
-        yield '"results":['
-        change = next(changes)
-        yield json.dumps(change)
-        for change in changes:
-            yield ',' + json.dumps(change)
-        yield ']}'
+        yield '{"results":['
+        num = 0
+        for batch in batches(changes):
+            if include_docs:
+                docs = db.load_many([change['id'] for change in batch])
+            for change in batch:
+                last_seq = change['seq']
+                if include_docs:
+                    change['doc'] = render_doc(docs[change['id']])
+                if seq_interval and num % seq_interval:
+                    change['seq'] = None
+                yield (num and ',' or '') + json.dumps(change)
+                num += 1
+        yield '],"last_seq":%s}' % json.dumps(last_seq)
+
     db = app.dbs[dbname]
-    last_seq = db.update_seq
 
     args = flask.request.args
     heartbeat = args.get('heartbeat', 10000)
-    since = json.loads(args.get('since', '0'))
     feed = args.get('feed', 'normal')
     style = args.get('style', 'all_docs')
     filter = args.get('filter', None)
-
-    changes = db.changes(since, feed, style, filter)
-    return flask.Response(generator(changes, last_seq),
+    try:
+        since = json.loads(args.get('since', '0'))
+        limit = json.loads(args.get('limit', 'null'))
+        descending = json.loads(args.get('descending', 'false'))
+        include_docs = json.loads(args.get('include_docs', 'false'))
+        seq_interval = json.loads(args.get('seq_interval', 'null'))
+    except ValueError as err:
+        return flask.abort(400, str(err))
+
+    changes = db.changes(since, feed, style, filter, limit, descending)
+    return flask.Response(generator(changes, since),
                           content_type='application/json')
 
 
+def batches(items, size=100):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
 def parse_multipart_data(stream, boundary):
     boundary = boundary.encode()
     next_boundary = boundary and b'--' + boundary or None
@@ -221,7 +456,7 @@ def parse_multipart_data(stream, boundary):
             state = 'headers'
             if stack:
                 headers, body = stack.pop()
-                yield headers, b''.join(body)
+                yield headers, join_body(body)
             stack.append(({}, []))
 
         if state == 'headers':
@@ -241,4 +476,137 @@ def parse_multipart_data(stream, boundary):
 
     if stack:
         headers, body = stack.pop()
-        yield headers, b''.join(body)
+        yield headers, join_body(body)
+
+
+def join_body(lines):
+    # CRLF before the boundary belongs to the delimiter, not to the body
+    body = b''.join(lines)
+    if body.endswith(b'\r\n'):
+        body = body[:-2]
+    return body
+
+
+def accepts(mimetype):
+    """Checks that client explicitly accepts specified mimetype"""
+    return mimetype in flask.request.accept_mimetypes.values()
+
+
+def attachment_data(att):
+    """Returns attachment content as bytes regardless was it uploaded
+    as multipart body or as base64 encoded string within JSON document"""
+    data = att['data']
+    if isinstance(data, bytes):
+        return data
+    return base64.b64decode(data)
+
+
+def with_atts_since(doc, revs, atts_since):
+    """Returns the document and revision position since which client misses
+    attachments: the highest one of atts_since revisions that are known
+    ancestors of the document. Document is expected to be loaded with
+    revisions history, which is dropped unless revs is True"""
+    since = 0
+    revisions = doc.get('_revisions')
+    if atts_since and revisions:
+        start = revisions['start']
+        known = set('%d-%s' % (start - i, revid)
+                    for i, revid in enumerate(revisions['ids']))
+        since = max([int(rev.split('-', 1)[0])
+                     for rev in atts_since if rev in known] or [0])
+    if not revs and '_revisions' in doc:
+        doc = dict(doc)
+        del doc['_revisions']
+    return doc, since
+
+
+def sent_attachments(doc, since=0):
+    """Returns names of attachments which content have to be sent: ones
+    which have data and are newer than since revision position"""
+    return [name for name, att in (doc.get('_attachments') or {}).items()
+            if 'data' in att and att.get('revpos', since + 1) > since]
+
+
+def render_doc(doc, since=0, attachments=False, follows=False):
+    """Returns JSON serializable copy of the document where attachments are
+    represented as stubs, base64 encoded data or marked as following in
+    multipart body. Attachments not newer than since revision position are
+    always stubs"""
+    if not doc.get('_attachments'):
+        return doc
+    sent = sent_attachments(doc, since) if attachments else ()
+    doc = dict(doc)
+    atts = doc['_attachments']
+    doc['_attachments'] = {}
+    for name, att in atts.items():
+        meta = dict((key, value) for key, value in att.items()
+                    if key not in ('data', 'stub', 'follows'))
+        if name not in sent:
+            meta['stub'] = True
+        elif follows:
+            meta['follows'] = True
+        else:
+            meta['data'] = base64.b64encode(attachment_data(att)).decode()
+        doc['_attachments'][name] = meta
+    return doc
+
+
+def missing_error(idx, rev):
+    return {'id': idx, 'rev': rev, 'error': 'not_found', 'reason': 'missing'}
+
+
+def doc_parts(doc, since=0):
+    """Yields multipart/related parts of the document followed by
+    its attachments as raw binary bodies"""
+    yield ([('Content-Type', 'application/json')],
+           json.dumps(render_doc(doc, since, True, True)).encode())
+    for name in sent_attachments(doc, since):
+        att = doc['_attachments'][name]
+        data = attachment_data(att)
+        yield ([('Content-Disposition', 'attachment; filename="%s"' % name),
+                ('Content-Type', att.get('content_type',
+                                         'application/octet-stream')),
+                ('Content-Length', str(len(data)))],
+               data)
+
+
+def result_part(idx, result, attachments, revs=False, atts_since=None):
+    """Returns multipart/mixed part for single result of
+    :meth:`~replipy.storage.ABCDatabase.open_revs`"""
+    if 'missing' in result:
+        body = json.dumps(missing_error(idx, result['missing']))
+        return [('Content-Type', 'application/json; error="true"')], \
+            body.encode()
+    doc, since = with_atts_since(result['ok'], revs, atts_since)
+    if attachments and sent_attachments(doc, since):
+        boundary = uuid.uuid4().hex
+        ctype = 'multipart/related; boundary="%s"' % boundary
+        return [('Content-Type', ctype)], \
+            iter_multipart_data(doc_parts(doc, since), boundary)
+    return [('Content-Type', 'application/json')], \
+        json.dumps(render_doc(doc, since)).encode()
+
+
+def make_multipart_response(mimetype, parts):
+    boundary = uuid.uuid4().hex
+    return flask.Response(
+        iter_multipart_data(parts, boundary),
+        content_type='%s; boundary="%s"' % (mimetype, boundary))
+
+
+def iter_multipart_data(parts, boundary):
+    """Streams multipart body for (headers, body) parts where body is either
+    bytes or iterable of bytes chunks"""
+    boundary = boundary.encode()
+    for headers, body in parts:
+        yield b'--' + boundary + b'\r\n'
+        for key, value in headers:
+            yield ('%s: %s\r\n' % (key, value)).encode()
+        yield b'\r\n'
+        if isinstance(body, bytes):
+            yield body
+        else:
+            for chunk in body:
+                yield chunk
+        yield b'\r\n'
+    yield b'--' + boundary + b'--'
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2013 Alexander Shorin
+# All rights reserved.
+#
+# This software is licensed as described in the file LICENSE, which
+# you should have received as part of this distribution.
+#
+
+"""One-to-many replication between databases.
+
+Fan-out replication pushes single source database into many targets. The
+source changes feed is read once per batch: batches and document bodies
+fetched for them are kept in the shared bounded buffer which serves all the
+targets. Each target keeps his own checkpoint in his own ``_local/``
+document, so targets progress independently. Targets which fall behind the
+buffer read the source on their own instead of holding fast ones.
+"""
+
+import hashlib
+import threading
+import time
+from .storage import ABCDatabase
+
+
+def copy_doc(doc):
+    """Returns copy of the document which target storage is free to modify.
+    Attachments are never modified once stored, so their data is shared"""
+    doc = dict(doc)
+    if doc.get('_attachments'):
+        doc['_attachments'] = dict((name, dict(att)) for name, att
+                                   in doc['_attachments'].items())
+    return doc
+
+
+class ChangesBatch(object):
+    """Batch of changes read from the source with lazily fetched
+    document bodies"""
+
+    def __init__(self, source, since, changes):
+        self.source = source
+        self.since = since
+        self.changes = changes
+        self.last_seq = changes[-1]['seq'] if changes else since
+        self._docs = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, seq):
+        return self.since <= seq < self.last_seq
+
+    def changes_since(self, since):
+        return [change for change in self.changes if change['seq'] > since]
+
+    def fetch(self, idrevs):
+        """Returns copies of documents for specified id - revs mapping.
+        Bodies which wasn't requested before are fetched from the source"""
+        with self._lock:
+            for idx, revs in idrevs.items():
+                revs = [rev for rev in revs if (idx, rev) not in self._docs]
+                if not revs:
+                    continue
+                for result in self.source.open_revs(idx, revs,
+                                                    revisions=True):
+                    if 'ok' in result:
+                        doc = result['ok']
+                        self._docs[(idx, doc['_rev'])] = doc
+            docs = [self._docs[(idx, rev)]
+                    for idx, revs in idrevs.items() for rev in revs
+                    if (idx, rev) in self._docs]
+        return [copy_doc(doc) for doc in docs]
+
+
+class ChangesBuffer(object):
+    """Bounded buffer of change batches shared between targets.
+
+    Batch is read from the source only by the target which reached the
+    newest retained sequence. Targets which are behind everything the buffer
+    holds get None and have to read the source on their own.
+    """
+
+    def __init__(self, source, batch_size=100, capacity=10):
+        self.source = source
+        self.batch_size = batch_size
+        self.capacity = capacity
+        self.reads = 0
+        self._batches = []
+        self._lock = threading.Lock()
+
+    def read(self, since):
+        """Reads batch of changes from the source bypassing the buffer"""
+        changes = list(self.source.changes(since, style='all_docs',
+                                           limit=self.batch_size))
+        return ChangesBatch(self.source, since, changes)
+
+    def get(self, since):
+        """Returns batch which holds changes after since sequence or None
+        if they are already evicted from the buffer"""
+        with self._lock:
+            for batch in self._batches:
+                if since in batch:
+                    return batch
+            head = max([batch.last_seq for batch in self._batches] or [0])
+            if since < head:
+                return None
+            batch = self.read(since)
+            self.reads += 1
+            if batch.changes:
+                self._batches.append(batch)
+                while len(self._batches) > self.capacity:
+                    self._batches.pop(0)
+            return batch
+
+
+class TargetReplication(object):
+    """Replication of the buffered source into single target"""
+
+    def __init__(self, buffer, target, rep_id=None):
+        self.buffer = buffer
+        self.target = target
+        if rep_id is None:
+            rep_id = hashlib.md5(('%s|%s' % (
+                buffer.source.name, target.name)).encode()).hexdigest()
+        self.rep_id = rep_id
+        self.docs_written = 0
+        self.doc_write_failures = 0
+        self.own_reads = 0
+        self.shared_reads = 0
+        self.error = None
+        self._log = None
+
+    @property
+    def log_id(self):
+        return '_local/%s' % self.rep_id
+
+    @property
+    def last_seq(self):
+        return self.load_log().get('source_last_seq', 0)
+
+    def load_log(self):
+        if self._log is None:
+            try:
+                self._log = dict(self.target.load(self.log_id))
+            except ABCDatabase.NotFound:
+                self._log = {'_id': self.log_id, 'history': []}
+        return self._log
+
+    def checkpoint(self, seq, docs_written, doc_write_failures=0):
+        log = self.load_log()
+        log['source_last_seq'] = seq
+        log['history'] = [{'recorded_seq': seq,
+                           'docs_written': docs_written,
+                           'doc_write_failures': doc_write_failures,
+                           'end_time': time.strftime('%a, %d %b %Y %H:%M:%S '
+                                                     'GMT', time.gmtime())}]\
+            + log['history'][:49]
+        _, rev = self.target.store(dict(log))
+        log['_rev'] = rev
+
+    def replicate_batch(self, batch, since):
+        changes = batch.changes_since(since)
+        if not changes:
+            return since
+        idrevs = {}
+        for change in changes:
+            if change['id'].startswith('_local/'):
+                continue
+            revs = idrevs.setdefault(change['id'], [])
+            revs.extend(item['rev'] for item in change['changes'])
+        missing = self.target.revs_diff(idrevs) if idrevs else {}
+        docs = batch.fetch(dict((idx, info['missing'])
+                                for idx, info in missing.items()))
+        failures = 0
+        if docs:
+            results = self.target.bulk_docs(docs, new_edits=False)
+            failures = sum('error' in result for result in results)
+            self.target.ensure_full_commit()
+        self.docs_written += len(docs) - failures
+        self.doc_write_failures += failures
+        seq = changes[-1]['seq']
+        self.checkpoint(seq, len(docs) - failures, failures)
+        return seq
+
+    def step(self):
+        """Replicates next batch of changes. Returns False when target
+        caught up with the source"""
+        since = self.last_seq
+        batch = self.buffer.get(since)
+        if batch is None:
+            self.own_reads += 1
+            batch = self.buffer.read(since)
+        else:
+            self.shared_reads += 1
+        return self.replicate_batch(batch, since) != since
+
+    def run(self):
+        try:
+            while self.step():
+                pass
+        except Exception as err:
+            self.error = err
+
+
+class FanoutReplication(object):
+    """Replicates source database into many targets at once.
+
+    :param source: :class:`~replipy.storage.ABCDatabase` to read from
+    :param targets: list of :class:`~replipy.storage.ABCDatabase` to write to
+    :param batch_size: number of changes read from the source at once
+    :param buffer_size: number of batches retained in shared buffer
+    """
+
+    def __init__(self, source, targets, batch_size=100, buffer_size=10):
+        self.buffer = ChangesBuffer(source, batch_size, buffer_size)
+        self.replications = [TargetReplication(self.buffer, target)
+                             for target in targets]
+
+    def run(self):
+        """Replicates all changes made in the source till the moment every
+        target caught up with it and returns replication status"""
+        threads = [threading.Thread(target=replication.run)
+                   for replication in self.replications]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self.status()
+
+    def status(self):
+        return {
+            'source_reads': self.buffer.reads,
+            'targets': [{
+                'target': replication.target.name,
+                'replication_id': replication.rep_id,
+                'source_last_seq': replication.last_seq,
+                'docs_written': replication.docs_written,
+                'doc_write_failures': replication.doc_write_failures,
+                'shared_reads': replication.shared_reads,
+                'own_reads': replication.own_reads,
+                'error': None if replication.error is None
+                else str(replication.error)
+            } for replication in self.replications]
+        }
@@ -8,23 +8,78 @@
 #
 
 import base64
+import bisect
 import hashlib
 import pickle
+import threading
 import time
 import uuid
 from abc import ABCMeta, abstractmethod
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
+try:
+    from collections.abc import MutableMapping
+except ImportError:  # pragma: no cover
+    from collections import MutableMapping
+from .bloom import BloomFilter
 
 _MetaDatabase = ABCMeta('_MetaDatabase', (object,), {})
 
+
+def compute_rev(doc):
+    """Returns new revision for the document based on his content"""
+    oldrev = doc.get('_rev')
+    if oldrev is None:
+        seq, _ = 0, None
+    else:
+        seq, _ = oldrev.split('-', 1)
+        seq = int(seq)
+    atts = doc.get('_attachments')
+    if atts:
+        # attachments are represented by their digests, so their content
+        # isn't hashed once again and stubs don't have to be resolved first
+        doc = dict(doc, _attachments=dict(
+            (name, att.get('digest')) for name, att in atts.items()))
+    sig = hashlib.md5(pickle.dumps(doc)).hexdigest()
+    newrev = '%d-%s' % (seq + 1, sig)
+    return newrev.lower()
+
+
+def attachment_digest(data):
+    return 'md5-%s' % base64.b64encode(hashlib.md5(data).digest()).decode()
+
+
+def prepare_doc(doc, new_edits=True):
+    """Computes digests of inline attachments and returns new revision of
+    the document if new_edits is True. Digest and length sent along with
+    attachment data are never trusted."""
+    doc.pop('_revisions', None)
+    for att in (doc.get('_attachments') or {}).values():
+        if 'data' in att:
+            data = att['data']
+            if not isinstance(data, bytes):
+                data = base64.b64decode(data)
+            att['digest'] = attachment_digest(data)
+            att['length'] = len(data)
+    return compute_rev(doc) if new_edits else None
+
+
 class ABCDatabase(_MetaDatabase):
 
+    #: Whether database handle could be closed and opened again without
+    #: loosing any data. Only persistent databases are evicted by
+    #: :class:`DatabaseManager`.
+    persistent = False
+
     class Conflict(Exception):
         """Raises in case of conflict updates"""
 
     class NotFound(Exception):
         """Raises in case attempt to query on missed document"""
 
+    class MissingStub(Exception):
+        """Raises in case attachment stub refers to attachment which parent
+        revision doesn't have"""
+
     def __init__(self, name):
         self._name = name
         self._start_time = int(time.time() * 10**6)
@@ -53,6 +108,16 @@ class ABCDatabase(_MetaDatabase):
             'update_seq': self.update_seq
         }
 
+    def memory_usage(self):
+        """Returns estimated amount of memory in bytes held by the handle"""
+        return 0
+
+    def close(self):
+        """Releases all resources held by the database handle"""
+
+    def compact(self):
+        """Compacts database storage"""
+
     @abstractmethod
     def contains(self, idx, rev=None):
         """Verifies that document with specified idx exists"""
@@ -63,8 +128,17 @@ class ABCDatabase(_MetaDatabase):
         or raises Conflict exception otherwise"""
 
     @abstractmethod
-    def load(self, idx, rev=None):
-        """Returns document by specified idx"""
+    def load(self, idx, rev=None, revs=False, conflicts=False):
+        """Returns document by specified idx. If revs is True, document
+        revision history is included as `_revisions` field. If conflicts is
+        True, conflicted revisions are listed in `_conflicts` field"""
+
+    @abstractmethod
+    def open_revs(self, idx, revs=None, latest=False, revisions=False):
+        """Returns list of ``{'ok': doc}`` or ``{'missing': rev}`` items for
+        specified leaf revisions of the document or for all of them if revs
+        is None. If latest is True, ancestor revisions are resolved to their
+        leafs"""
 
     @abstractmethod
     def store(self, doc, rev=None):
@@ -87,159 +161,798 @@ class ABCDatabase(_MetaDatabase):
         """Ensures that all changes are actually stored on disk"""
 
     @abstractmethod
-    def changes(self, since=0, feed='normal', style='all_docs', filter=None):
-        """Ensures that all changes are actually stored on disk"""
+    def changes(self, since=0, feed='normal', style='all_docs', filter=None,
+                limit=None, descending=False):
+        """Iterates over change events happened after since sequence"""
+
+    @abstractmethod
+    def all_docs(self, startkey=None, endkey=None, limit=None, skip=0,
+                 descending=False, filter=None):
+        """Iterates over (id, rev) pairs of documents sorted by id"""
+
+    def load_many(self, idxs, conflicts=False):
+        """Returns mapping of specified ids to their latest revisions,
+        deleted ones included. Missed documents are omitted. If conflicts is
+        True, conflicted revisions are listed in `_conflicts` field.
+
+        Backends are encouraged to override this method to fetch all
+        documents at once."""
+        res = {}
+        for idx in idxs:
+            try:
+                docs = self.open_revs(idx)
+            except self.NotFound:
+                continue
+            doc = docs[0]['ok']
+            revs = [item['ok']['_rev'] for item in docs[1:]
+                    if not item['ok'].get('_deleted')]
+            if conflicts and revs:
+                doc = dict(doc, _conflicts=revs)
+            res[idx] = doc
+        return res
 
     @abstractmethod
     def add_attachment(self, doc, name, data, ctype='application/octet-stream'):
         """Adds attachment to specified document"""
 
 
-class MemoryDatabase(ABCDatabase):
+class DatabaseManager(MutableMapping):
+    """Registry of databases which opens them on first access and keeps
+    bounded LRU of open handles.
+
+    Handles are evicted when there are more than `max_open` of them or their
+    total :meth:`ABCDatabase.memory_usage` exceeds `max_memory` bytes; usage
+    of the handle is measured when it's accessed and when it's released.
+    Evicted handles are flushed with :meth:`ABCDatabase.ensure_full_commit`
+    and closed; non persistent ones and those which are in use, see
+    :meth:`acquire`, are never evicted.
+    """
+
+    class DatabaseExists(Exception):
+        """Raises in case attempt to create database which already exists"""
+
+    def __init__(self, factory, names=(), max_open=None, max_memory=None):
+        self._factory = factory
+        self._names = sorted(set(names))
+        self._handles = OrderedDict()
+        # persistent handles which aren't in use, least recently used first
+        self._evictable = OrderedDict()
+        self._pins = {}
+        self._usage = {}
+        self._memory = 0
+        self._max_open = max_open
+        self._max_memory = max_memory
+        self._lock = threading.RLock()
+
+    def __contains__(self, name):
+        idx = bisect.bisect_left(self._names, name)
+        return idx < len(self._names) and self._names[idx] == name
+
+    def __getitem__(self, name):
+        with self._lock:
+            if name in self._handles:
+                db = self._handles.pop(name)
+            elif name in self:
+                db = self._factory(name)
+            else:
+                raise KeyError(name)
+            self._handles[name] = db
+            self._touch(name)
+            self._evict()
+            return db
+
+    def __setitem__(self, name, db):
+        with self._lock:
+            if name not in self:
+                bisect.insort(self._names, name)
+            old = self._handles.pop(name, None)
+            if old is not None and old is not db:
+                old.close()
+            self._handles[name] = db
+            self._touch(name)
+            self._evict()
+
+    def __delitem__(self, name):
+        with self._lock:
+            if name not in self:
+                raise KeyError(name)
+            self._names.pop(bisect.bisect_left(self._names, name))
+            db = self._handles.pop(name, None)
+            self._evictable.pop(name, None)
+            self._memory -= self._usage.pop(name, 0)
+            if db is not None:
+                db.close()
+
+    def __iter__(self):
+        return self.all_dbs()
+
+    def __len__(self):
+        return len(self._names)
 
-    def __init__(self, *args, **kwargs):
-        super(MemoryDatabase, self).__init__(*args, **kwargs)
+    @property
+    def open_handles(self):
+        """Returns names of currently opened databases, least recently used
+        first"""
+        return list(self._handles)
+
+    def create(self, name):
+        """Creates new database and returns his handle. Raises
+        :exc:`DatabaseExists` if database with such name is already known"""
+        with self._lock:
+            if name in self:
+                raise self.DatabaseExists(name)
+            db = self._factory(name)
+            self[name] = db
+            return db
+
+    def acquire(self, name):
+        """Returns database handle which is kept open until it's passed back
+        to :meth:`release`. Raises :exc:`KeyError` for unknown database"""
+        with self._lock:
+            db = self[name]
+            self._pins[name] = self._pins.get(name, 0) + 1
+            self._evictable.pop(name, None)
+            return db
+
+    def release(self, name):
+        """Releases database handle obtained with :meth:`acquire`"""
+        with self._lock:
+            count = self._pins.pop(name) - 1
+            if count:
+                self._pins[name] = count
+            if name in self._handles:
+                self._touch(name)
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            while self._handles:
+                self._handles.popitem()[1].close()
+            self._evictable.clear()
+            del self._names[:]
+            self._usage.clear()
+            self._memory = 0
+
+    def all_dbs(self, startkey=None, endkey=None, limit=None, skip=0,
+                descending=False, chunk_size=1000):
+        """Iterates over database names in sorted order.
+
+        Names are fetched by chunks, so registry lock isn't held while
+        consumer processes them and databases created or deleted in the
+        meanwhile doesn't break iteration.
+        """
+        last = None
+        while limit is None or limit > 0:
+            with self._lock:
+                names = self._names
+                if descending:
+                    if last is not None:
+                        hi = bisect.bisect_left(names, last)
+                    elif startkey is not None:
+                        hi = bisect.bisect_right(names, startkey)
+                    else:
+                        hi = len(names)
+                    lo = 0 if endkey is None else bisect.bisect_left(names,
+                                                                     endkey)
+                    chunk = names[max(lo, hi - chunk_size):hi][::-1]
+                else:
+                    if last is not None:
+                        lo = bisect.bisect_right(names, last)
+                    elif startkey is not None:
+                        lo = bisect.bisect_left(names, startkey)
+                    else:
+                        lo = 0
+                    hi = len(names) if endkey is None else bisect.bisect_right(
+                        names, endkey)
+                    chunk = names[lo:min(hi, lo + chunk_size)]
+            if not chunk:
+                return
+            last = chunk[-1]
+            if skip:
+                skipped, chunk = chunk[:skip], chunk[skip:]
+                skip -= len(skipped)
+            if limit is not None:
+                chunk = chunk[:limit]
+                limit -= len(chunk)
+            for name in chunk:
+                yield name
+
+    def _touch(self, name):
+        db = self._handles[name]
+        self._evictable.pop(name, None)
+        if db.persistent and name not in self._pins:
+            self._evictable[name] = True
+        # total memory usage is updated on each handle access instead of
+        # being summed up over all open handles
+        if self._max_memory is not None:
+            usage = db.memory_usage()
+            self._memory += usage - self._usage.get(name, 0)
+            self._usage[name] = usage
+
+    def _over_limits(self):
+        return (self._max_open is not None
+                and len(self._handles) > self._max_open
+                or self._max_memory is not None
+                and self._memory > self._max_memory)
+
+    def _evict(self):
+        # only evictable handles are looked at, so cost doesn't depend on
+        # number of open non persistent or acquired ones
+        while self._evictable and self._over_limits():
+            # most recently used handle is the one that is going to be used
+            recent = next(reversed(self._handles))
+            names = iter(self._evictable)
+            name = next(names)
+            if name == recent:
+                name = next(names, None)
+                if name is None:
+                    break
+            del self._evictable[name]
+            db = self._handles.pop(name)
+            self._memory -= self._usage.pop(name, 0)
+            db.ensure_full_commit()
+            db.close()
+
+
+class LocalDocuments(object):
+    """Lightweight store of ``_local`` documents.
+
+    Local documents are never replicated, so they don't get hashed revisions
+    and don't show up in the changes feed: revision is just ``0-N`` counter
+    and the last write always wins. Writes are coalesced in memory and
+    passed to `persist` callable by batches on :meth:`flush`, which happens
+    on :meth:`ABCDatabase.ensure_full_commit` or each `flush_interval`
+    seconds if one is set. Batch maps document id to the latest document
+    or to None if it was removed.
+    """
+
+    def __init__(self, persist=None, flush_interval=None):
         self._docs = {}
+        self._pending = {}
+        self._persist = persist
+        self._flush_interval = flush_interval
+        self._timer = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self.writes = 0
+        self.flushes = 0
+
+    def __contains__(self, idx):
+        return idx in self._docs
+
+    def __len__(self):
+        return len(self._docs)
+
+    @property
+    def pending(self):
+        """Returns number of documents waiting to be persisted"""
+        return len(self._pending)
+
+    def get(self, idx):
+        return self._docs.get(idx)
+
+    def store(self, doc):
+        idx = doc['_id']
+        with self._lock:
+            old = self._docs.get(idx)
+            num = int(old['_rev'].split('-', 1)[1]) if old else 0
+            doc['_rev'] = '0-%d' % (num + 1)
+            self._docs[idx] = doc
+            self._pending[idx] = doc
+            self.writes += 1
+            self._schedule()
+        return idx, doc['_rev']
+
+    def remove(self, idx):
+        with self._lock:
+            del self._docs[idx]
+            self._pending[idx] = None
+            self.writes += 1
+            self._schedule()
+        return idx, '0-0'
+
+    def _schedule(self):
+        if self._flush_interval is None or self._timer is not None:
+            return
+        self._timer = threading.Timer(self._flush_interval, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def flush(self):
+        """Persists all pending writes at once. If `persist` fails, writes
+        are kept pending till the next flush"""
+        # batches are persisted in order they were taken, but writes aren't
+        # blocked while it happens
+        with self._flush_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                batch, self._pending = self._pending, {}
+            if not batch:
+                return
+            try:
+                if self._persist is not None:
+                    self._persist(batch)
+            except Exception:
+                with self._lock:
+                    for idx, doc in batch.items():
+                        self._pending.setdefault(idx, doc)
+                    self._schedule()
+                raise
+            with self._lock:
+                self.flushes += 1
+
+    def close(self):
+        self.flush()
+
+
+class MemoryDatabase(ABCDatabase):
+    """Database which holds everything in memory.
+
+    If `revs_filter_capacity` is specified, stored (id, rev) pairs are also
+    tracked by :class:`~replipy.bloom.BloomFilter` sized for that number of
+    revisions. :meth:`revs_diff` consults it first and looks up primary
+    storage only for revisions which probably exist. Filter grows
+    when gets full and rebuilt by :meth:`compact`.
+
+    ``_local`` documents are kept in :class:`LocalDocuments` store, which
+    flushes them each `local_flush_interval` seconds if specified. Flushed
+    batches are passed to :meth:`persist_local`.
+
+    Like in CouchDB, only last `revs_limit` revisions of each document branch
+    are remembered.
+    """
+
+    def __init__(self, name, revs_filter_capacity=None,
+                 local_flush_interval=None, revs_limit=1000):
+        super(MemoryDatabase, self).__init__(name)
+        self._revs_limit = revs_limit
+        # guards all document updates, server may run requests in threads
+        self._lock = threading.RLock()
+        self._local = LocalDocuments(self.persist_local, local_flush_interval)
+        self._revs_filter = None
+        if revs_filter_capacity is not None:
+            self._revs_filter = BloomFilter(revs_filter_capacity)
+        self._docs = {}
+        self._leafs = {}
+        self._revs = {}
+        self._conflicts = set()
         self._changes = {}
+        self._seqs = []
+        self._seq_ids = {}
 
-    def _new_rev(self, doc):
-        oldrev = doc.get('_rev')
-        if oldrev is None:
-            seq, _ = 0, None
-        else:
-            seq, _ = oldrev.split('-', 1)
-            seq = int(seq)
-        sig = hashlib.md5(pickle.dumps(doc)).hexdigest()
-        newrev = '%d-%s' % (seq + 1, sig)
-        return newrev.lower()
+    def info(self):
+        info = super(MemoryDatabase, self).info()
+        info['conflict_count'] = len(self._conflicts)
+        return info
+
+    def close(self):
+        self._local.close()
+
+    def persist_local(self, batch):
+        """Stores batch of coalesced ``_local`` document writes. Batch maps
+        document id to the latest document or to None if it was removed.
+        Nothing to do for memory database, persistent backends should
+        override it"""
 
     def check_for_conflicts(self, idx, rev):
+        if idx.startswith('_local/'):
+            # last write wins
+            return
         if self.contains(idx):
             if rev is None:
-                if idx.startswith('_local/'):
-                    return
                 raise self.Conflict('Document update conflict')
-            elif not self.contains(idx, rev):
+            elif not self.contains(idx, rev) \
+                    or self._leafs[idx][rev][0].get('_deleted'):
                 raise self.Conflict('Document update conflict')
         elif rev is not None:
             raise self.Conflict('Document update conflict')
 
     def contains(self, idx, rev=None):
+        if idx.startswith('_local/'):
+            return idx in self._local
         if idx not in self._docs:
             return False
-        doc = self._docs[idx]
         if rev is None:
-            return not doc.get('_deleted', False)
-        return self._docs[idx]['_rev'] == rev
-
-    def load(self, idx, rev=None):
-        if not self.contains(idx, rev):
-            raise self.NotFound(idx)
-        return self._docs[idx]
+            return not self._docs[idx].get('_deleted', False)
+        return rev in self._leafs[idx]
+
+    def load(self, idx, rev=None, revs=False, conflicts=False):
+        if idx.startswith('_local/'):
+            doc = self._local.get(idx)
+            if doc is None:
+                raise self.NotFound(idx)
+            return doc
+        # winner and leafs are read together, so they are consistent with
+        # each other while the document is being updated
+        with self._lock:
+            if not self.contains(idx, rev):
+                raise self.NotFound(idx)
+            if rev is None:
+                rev = self._docs[idx]['_rev']
+            doc, path = self._leafs[idx][rev]
+            if revs:
+                doc = dict(doc, _revisions=self._revisions(path))
+            if conflicts and idx in self._conflicts:
+                doc = dict(doc, _conflicts=self.conflicts(idx))
+            return doc
+
+    def conflicts(self, idx):
+        """Returns list of conflicted revisions of the document"""
+        with self._lock:
+            winner = self._docs[idx]['_rev']
+            return sorted((rev for rev, (doc, _) in self._leafs[idx].items()
+                           if rev != winner and not doc.get('_deleted')),
+                          key=self._rev_key, reverse=True)
+
+    def open_revs(self, idx, revs=None, latest=False, revisions=False):
+        with self._lock:
+            if idx not in self._docs:
+                if revs is None:
+                    raise self.NotFound(idx)
+                return [{'missing': rev} for rev in revs]
+            leafs = self._leafs[idx]
+            if revs is None:
+                revs = sorted(leafs, key=self._rev_key, reverse=True)
+            res = []
+            found = set()
+            for rev in revs:
+                if rev in leafs:
+                    matched = [rev]
+                elif latest and rev in self._revs[idx]:
+                    matched = [leaf for leaf, (_, path) in leafs.items()
+                               if rev in path]
+                else:
+                    res.append({'missing': rev})
+                    continue
+                for leaf in matched:
+                    if leaf in found:
+                        continue
+                    found.add(leaf)
+                    doc, path = leafs[leaf]
+                    if revisions:
+                        doc = dict(doc, _revisions=self._revisions(path))
+                    res.append({'ok': doc})
+            return res
+
+    def _rev_key(self, rev):
+        pos, sig = rev.split('-', 1)
+        return int(pos), sig
+
+    def _winner(self, leafs):
+        def key(rev):
+            return not leafs[rev][0].get('_deleted'), self._rev_key(rev)
+        return leafs[max(leafs, key=key)][0]
+
+    def _revisions(self, path):
+        return {
+            'start': int(path[0].split('-', 1)[0]),
+            'ids': [rev.split('-', 1)[1] for rev in path]
+        }
 
     def store(self, doc, rev=None, new_edits=True):
+        with self._lock:
+            return self._store(doc, rev, new_edits)
+
+    def _store(self, doc, rev=None, new_edits=True):
         if '_id' not in doc:
             doc['_id'] = str(uuid.uuid4()).lower()
         if rev is None:
             rev = doc.get('_rev')
+        elif new_edits:
+            doc['_rev'] = rev
 
         idx = doc['_id']
+        if idx.startswith('_local/'):
+            doc.pop('_revisions', None)
+            return self._local.store(doc)
+        revisions = doc.pop('_revisions', None)
 
         if new_edits:
             self.check_for_conflicts(idx, rev)
-            doc['_rev'] = self._new_rev(doc)
+        newrev = prepare_doc(doc, new_edits)
+
+        leafs = self._leafs.get(idx, {})
+        limit = self._revs_limit
+        if new_edits:
+            # only direct parent is touched, so update cost doesn't depend
+            # on the length of document history
+            doc['_rev'] = newrev
+            if rev in leafs:
+                parent, parent_path = leafs[rev]
+                path = [newrev] + parent_path[:limit - 1]
+                ancestors = [rev]
+                stemmed = parent_path[limit - 1:]
+            else:
+                parent, path, ancestors, stemmed = None, [newrev], [], []
+            added = [newrev]
         else:
             assert rev, 'Document revision missed'
+            if rev in self._revs.get(idx, ()):
+                # revision is already known, nothing to do
+                return idx, rev
             doc['_rev'] = rev
+            if revisions:
+                start = revisions['start']
+                path = ['%d-%s' % (start - i, revid)
+                        for i, revid in enumerate(revisions['ids'][:limit])]
+            if not revisions or path[0] != rev:
+                path = [rev]
+            ancestors = [ancestor for ancestor in path[1:]
+                         if ancestor in leafs]
+            parent = leafs[ancestors[0]][0] if ancestors else None
+            stemmed = []
+            kept = set(path)
+            for ancestor in ancestors:
+                stemmed.extend(item for item in leafs[ancestor][1]
+                               if item not in kept)
+            added = path
+
+        self._resolve_stubs(doc, parent, new_edits)
+        for ancestor in ancestors:
+            leafs.pop(ancestor, None)
 
         idx, rev = doc['_id'], doc['_rev']
 
-        self._docs[idx] = doc
+        leafs[rev] = (doc, path)
+        self._leafs[idx] = leafs
+        self._docs[idx] = self._winner(leafs)
+        if self._revs_filter is not None:
+            known = self._revs.get(idx, ())
+            keys = [(idx, item) for item in added if item not in known]
+            if idx not in self._revs:
+                keys.append(idx)
+            self._filter_keys(keys)
+        known = self._revs.setdefault(idx, set())
+        known.update(added)
+        for item in stemmed:
+            # revisions beyond revs_limit are forgotten unless another
+            # branch still refers to them
+            if not any(item in leaf_path for _, leaf_path in leafs.values()):
+                known.discard(item)
+        if sum(not leaf.get('_deleted') for leaf, _ in leafs.values()) > 1:
+            self._conflicts.add(idx)
+        else:
+            self._conflicts.discard(idx)
         self._update_seq += 1
+        oldseq = self._changes.get(idx)
+        if oldseq is not None:
+            self._seqs.pop(bisect.bisect_left(self._seqs, oldseq))
+            del self._seq_ids[oldseq]
         self._changes[idx] = self._update_seq
+        self._seqs.append(self._update_seq)
+        self._seq_ids[self._update_seq] = idx
 
         return idx, rev
 
+    def _resolve_stubs(self, doc, parent, new_edits=True):
+        atts = doc.get('_attachments')
+        if not atts:
+            return
+        parent_atts = (parent or {}).get('_attachments') or {}
+        revpos = int(doc['_rev'].split('-', 1)[0])
+        for name, att in atts.items():
+            if att.get('stub'):
+                if name not in parent_atts:
+                    raise self.MissingStub(
+                        'Attachment %s stub has no data in parent revision'
+                        % name)
+                # attachments are never modified once stored, so parent's
+                # one is shared instead of copied
+                atts[name] = parent_atts[name]
+            elif new_edits:
+                # attachment with data is new or changed in this revision
+                att['revpos'] = revpos
+            else:
+                att.setdefault('revpos', revpos)
+
     def remove(self, idx, rev):
-        if not self.contains(idx):
-            raise self.NotFound(idx)
-        elif not self.contains(idx, rev):
-            raise self.Conflict('Document update conflict')
-        doc = {
-            '_id': idx,
-            '_rev': rev,
-            '_deleted': True
-        }
-        return self.store(doc, rev)
+        with self._lock:
+            if not self.contains(idx):
+                raise self.NotFound(idx)
+            if idx.startswith('_local/'):
+                return self._local.remove(idx)
+            elif not self.contains(idx, rev):
+                raise self.Conflict('Document update conflict')
+            doc = {
+                '_id': idx,
+                '_rev': rev,
+                '_deleted': True
+            }
+            return self._store(doc, rev)
+
+    def _filter_keys(self, keys):
+        # filter holds (id, rev) pairs of known revisions and ids of known
+        # documents
+        revs_filter = self._revs_filter
+        if revs_filter.count + len(keys) > revs_filter.capacity:
+            self._rebuild_revs_filter(2 * max(revs_filter.capacity,
+                                              revs_filter.count + len(keys)))
+            revs_filter = self._revs_filter
+        for key in keys:
+            revs_filter.add(key)
+
+    def _rebuild_revs_filter(self, capacity):
+        revs_filter = BloomFilter(capacity, self._revs_filter.error_rate)
+        for idx, revs in self._revs.items():
+            revs_filter.add(idx)
+            for rev in revs:
+                revs_filter.add((idx, rev))
+        self._revs_filter = revs_filter
+
+    def compact(self):
+        if self._revs_filter is None:
+            return
+        # filter must not miss revisions stored while it's rebuilt
+        with self._lock:
+            count = sum(len(revs) + 1 for revs in self._revs.values())
+            self._rebuild_revs_filter(max(2 * count,
+                                          self._revs_filter.capacity))
 
     def revs_diff(self, idrevs):
+        if self._revs_filter is not None:
+            return self._filtered_revs_diff(idrevs)
         res = defaultdict(dict)
         for idx, revs in idrevs.items():
             missing = []
-            if not self.contains(idx):
+            if idx not in self._revs:
                 missing.extend(revs)
                 res[idx]['missing'] = missing
                 continue
-            doc = self._docs[idx]
+            known = self._revs[idx]
             for rev in revs:
-                if doc['_rev'] != rev:
+                if rev not in known:
                     missing.append(rev)
             if missing:
                 res[idx]['missing'] = missing
+                self._add_possible_ancestors(res[idx], idx, missing)
+        return res
+
+    def _add_possible_ancestors(self, info, idx, missing):
+        # leafs which may be ancestors of missed revisions let replicator
+        # send only attachments added since them
+        with self._lock:
+            leafs = list(self._leafs.get(idx, ()))
+        pos = max(self._rev_key(rev)[0] for rev in missing)
+        ancestors = sorted((leaf for leaf in leafs
+                            if self._rev_key(leaf)[0] < pos),
+                           key=self._rev_key, reverse=True)
+        if ancestors:
+            info['possible_ancestors'] = ancestors
+
+    def _filtered_revs_diff(self, idrevs):
+        # first pass answers from the filter alone, second one looks up
+        # primary storage only for revisions which may be known
+        revs_filter = self._revs_filter
+        maybe = {}
+        for idx, revs in idrevs.items():
+            for rev in revs:
+                if (idx, rev) in revs_filter:
+                    maybe.setdefault(idx, set()).add(rev)
+        found = {}
+        for idx, revs in maybe.items():
+            known = self._revs.get(idx, ())
+            found[idx] = set(rev for rev in revs if rev in known)
+        res = defaultdict(dict)
+        for idx, revs in idrevs.items():
+            known = found.get(idx, ())
+            missing = [rev for rev in revs if rev not in known]
+            if missing:
+                res[idx]['missing'] = missing
+                if idx in revs_filter:
+                    self._add_possible_ancestors(res[idx], idx, missing)
         return res
 
     def bulk_docs(self, docs, new_edits=True):
         res = []
-        for doc in docs:
-            try:
-                idx, rev = self.store(doc, None, new_edits)
-                res.append({
-                    'ok': True,
-                    'id': idx,
-                    'rev': rev
-                })
-            except Exception as err:
-                res.append({'id': doc.get('_id'),
-                            'error': type(err).__name__,
-                            'reason': str(err)})
+        with self._lock:
+            for doc in docs:
+                try:
+                    idx, rev = self._store(doc, None, new_edits)
+                    res.append({
+                        'ok': True,
+                        'id': idx,
+                        'rev': rev
+                    })
+                except Exception as err:
+                    res.append({'id': doc.get('_id'),
+                                'error': type(err).__name__,
+                                'reason': str(err)})
         return res
 
     def ensure_full_commit(self):
+        self._local.flush()
         return {
             'ok': True,
             'instance_start_time': self.info()['instance_start_time']
         }
 
-    def changes(self, since=0, feed='normal', style='all_docs', filter=None):
-        changes = sorted(self._changes.items(), key=lambda i: i[1])
-        if since:
-            for idx, seq in changes:
-                if since <= seq:
-                    yield self.make_event(idx, seq)
-                    break
-        for idx, seq in changes:
-            yield self.make_event(idx, seq)
+    def changes(self, since=0, feed='normal', style='all_docs', filter=None,
+                limit=None, descending=False):
+        # feed is taken as snapshot, so concurrent updates neither break
+        # iteration nor make it skip documents
+        with self._lock:
+            if filter == '_conflicts':
+                seqs = sorted(self._changes[idx] for idx in self._conflicts)
+            else:
+                seqs = self._seqs
+            seqs = seqs[bisect.bisect_right(seqs, since):]
+            if descending:
+                seqs.reverse()
+            if limit is not None:
+                seqs = seqs[:limit]
+            items = [(seq, self._seq_ids[seq]) for seq in seqs]
+        for seq, idx in items:
+            yield self.make_event(idx, seq, style)
+
+    def load_many(self, idxs, conflicts=False):
+        res = {}
+        with self._lock:
+            for idx in idxs:
+                doc = self._docs.get(idx)
+                if doc is None:
+                    continue
+                if conflicts and idx in self._conflicts:
+                    doc = dict(doc, _conflicts=self.conflicts(idx))
+                res[idx] = doc
+        return res
 
     def add_attachment(self, doc, name, data, ctype='application/octet-stream'):
-        atts = doc.setdefault('_attachments')
-        digest = 'md5-%s' % base64.b64encode(hashlib.md5(data).digest()).decode()
-        if doc.get('_rev'):
+        atts = doc.setdefault('_attachments', {})
+        # replicated revisions come with revpos in attachment metadata
+        revpos = (atts.get(name) or {}).get('revpos')
+        if revpos is None and doc.get('_rev'):
             revpos = int(doc['_rev'].split('-')[0]) + 1
-        else:
+        elif revpos is None:
             revpos = 1
+        # digest is computed on store
         atts[name] = {
             'data': data,
-            'digest': digest,
             'length': len(data),
             'content_type': ctype,
             'revpos': revpos
         }
 
-    def make_event(self, idx, seq):
-        doc = self._docs[idx]
+    def all_docs(self, startkey=None, endkey=None, limit=None, skip=0,
+                 descending=False, filter=None):
+        # ids and revisions are taken as snapshot, like in changes()
+        with self._lock:
+            if filter == '_conflicts':
+                revs = dict((idx, self._docs[idx]['_rev'])
+                            for idx in self._conflicts)
+            else:
+                revs = dict((idx, doc['_rev'])
+                            for idx, doc in self._docs.items()
+                            if not doc.get('_deleted'))
+        idxs = sorted(revs)
+        if descending:
+            lo = 0 if endkey is None else bisect.bisect_left(idxs, endkey)
+            hi = len(idxs) if startkey is None else bisect.bisect_right(
+                idxs, startkey)
+            idxs = idxs[lo:hi][::-1]
+        else:
+            lo = 0 if startkey is None else bisect.bisect_left(idxs, startkey)
+            hi = len(idxs) if endkey is None else bisect.bisect_right(
+                idxs, endkey)
+            idxs = idxs[lo:hi]
+        idxs = idxs[skip:]
+        if limit is not None:
+            idxs = idxs[:limit]
+        for idx in idxs:
+            yield idx, revs[idx]
+
+    def make_event(self, idx, seq, style='all_docs'):
+        with self._lock:
+            doc = self._docs[idx]
+            revs = [doc['_rev']]
+            if style == 'all_docs':
+                revs.extend(sorted((rev for rev in self._leafs[idx]
+                                    if rev != doc['_rev']),
+                                   key=self._rev_key, reverse=True))
         event = {
             'id': idx,
-            'changes': [{'rev': doc['_rev']}],
+            'changes': [{'rev': rev} for rev in revs],
             'seq': seq
         }
         if doc.get('_deleted'):
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2013 Alexander Shorin
+# All rights reserved.
+#
+# This software is licensed as described in the file LICENSE, which
+# you should have received as part of this distribution.
+#
+
+"""Test suite for case when Replipy acts as read replica of another peer"""
+
+import json
+import threading
+import unittest
+import flask
+import werkzeug.serving
+from replipy.follower import Follower, follow
+from replipy.peer import replipy
+from replipy.storage import MemoryDatabase
+
+
+def make_app(db_cls=MemoryDatabase, **options):
+    app = flask.Flask(__name__)
+    app.config['TESTING'] = True
+    app.register_blueprint(replipy, db_cls=db_cls, **options)
+    return app
+
+
+class FailingDatabase(MemoryDatabase):
+
+    failing = set()
+
+    def _store(self, doc, *args, **kwargs):
+        if doc['_id'] in self.failing:
+            raise self.Conflict('Document update conflict')
+        return super(FailingDatabase, self)._store(doc, *args, **kwargs)
+
+
+class FollowerTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.leader = make_app()
+        cls.server = werkzeug.serving.make_server('127.0.0.1', 0, cls.leader,
+                                                  threaded=True)
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+        cls.leader_url = 'http://127.0.0.1:%d' % cls.server.server_port
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.thread.join()
+
+    def setUp(self):
+        self.leader.dbs.clear()
+        self.source = self.leader.dbs.create('db')
+        self.source.bulk_docs([{'_id': 'doc%d' % i} for i in range(5)])
+        doc = dict(self.source.load('doc0'))
+        self.source.add_attachment(doc, 'a.txt', b'hello', 'text/plain')
+        self.source.store(doc)
+        self.app = make_app(FailingDatabase, leader=self.leader_url)
+        self.client = self.app.test_client()
+        self.follower = Follower(self.app.dbs, 'db',
+                                 '%s/db' % self.leader_url, batch_size=2)
+        self.app.dbs.create('db')
+        self.app.followers['db'] = self.follower
+
+    def sync(self):
+        while self.follower.step():
+            pass
+
+    def decode(self, rv):
+        return json.loads(rv.data.decode())
+
+    def test_sync(self):
+        self.sync()
+        db = self.app.dbs['db']
+        for idx in ('doc%d' % i for i in range(5)):
+            assert db.load(idx)['_rev'] == self.source.load(idx)['_rev']
+
+        rv = self.client.get('/db/doc0?attachments=true')
+        att = self.decode(rv)['_attachments']['a.txt']
+        assert att['data'] == 'aGVsbG8='
+
+    def test_write_failures(self):
+        FailingDatabase.failing.add('doc2')
+        try:
+            assert self.follower.step() == 1
+            assert self.follower.step() == 0
+            status = self.follower.status()
+            assert status['doc_write_failures'] == 2
+            assert status['local_seq'] == 2
+            assert not self.app.dbs['db'].contains('doc2')
+        finally:
+            FailingDatabase.failing.clear()
+
+        self.sync()
+        assert self.app.dbs['db'].contains('doc2')
+        assert self.follower.status()['lag_seqs'] == 0
+
+    def test_updated_while_fetched(self):
+        source = self.source
+
+        class RacingFollower(Follower):
+            def fetch(self, missing):
+                if 'doc1' in missing:
+                    source.store({'_id': 'doc1',
+                                  '_rev': source.load('doc1')['_rev']})
+                return super(RacingFollower, self).fetch(missing)
+
+        follower = RacingFollower(self.app.dbs, 'db',
+                                  '%s/db' % self.leader_url, batch_size=2)
+        assert follower.step() == 2
+        status = follower.status()
+        assert status['doc_write_failures'] == 0
+        assert status['local_seq'] == 3
+        doc = self.app.dbs['db'].load('doc1')
+        assert doc['_rev'] == source.load('doc1')['_rev']
+
+    def test_resume(self):
+        self.sync()
+        _, rev = self.source.store({'_id': 'doc1',
+                                    '_rev': self.source.load('doc1')['_rev']})
+        follower = Follower(self.app.dbs, 'db', '%s/db' % self.leader_url)
+        assert follower.step() == 1
+        assert self.app.dbs['db'].load('doc1')['_rev'] == rev
+
+    def test_lag(self):
+        self.follower.step()
+        status = self.decode(self.client.get('/db/'))['follower']
+        assert status['leader_seq'] == self.source.update_seq
+        assert status['lag_seqs'] == 3
+        assert status['lag_seconds'] >= 0
+
+        self.sync()
+        status = self.decode(self.client.get('/db/'))['follower']
+        assert status['lag_seqs'] == 0
+        assert status['lag_seconds'] == 0
+
+    def test_serve_reads(self):
+        self.sync()
+        rv = self.client.get('/db/_all_docs?startkey="doc"&endkey="doc9"')
+        assert len(self.decode(rv)['rows']) == 5
+
+        rv = self.client.get('/db/doc3')
+        assert rv.status_code == 200
+
+    def test_reject_writes(self):
+        rv = self.client.put('/db/doc', data='{}',
+                             content_type='application/json')
+        assert rv.status_code == 403
+        assert self.decode(rv)['error'] == 'forbidden'
+
+        rv = self.client.post('/db/_bulk_docs', data='{"docs": []}',
+                              content_type='application/json')
+        assert rv.status_code == 403
+
+        rv = self.client.put('/db/_local/checkpoint', data='{}',
+                             content_type='application/json')
+        assert rv.status_code == 201
+
+    def test_forward_writes(self):
+        app = make_app(leader=self.leader_url, leader_writes='forward')
+        app.dbs.create('db')
+        rv = app.test_client().put('/db/new', data='{"foo": "bar"}',
+                                   content_type='application/json')
+        assert rv.status_code == 201
+        assert self.source.load('new')['foo'] == 'bar'
+        assert 'new' not in app.dbs['db']._docs
+
+    def test_follow(self):
+        app = make_app(leader=self.leader_url)
+        follower = follow(app, 'db', interval=0.01)
+        try:
+            for _ in range(500):
+                if follower.status()['local_seq'] == self.source.update_seq:
+                    break
+                threading.Event().wait(0.01)
+        finally:
+            follower.stop()
+        assert app.dbs['db'].contains('doc4')
+
+
+if __name__ == '__main__':
+    unittest.main()
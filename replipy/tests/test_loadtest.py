@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2013 Alexander Shorin
+# All rights reserved.
+#
+# This software is licensed as described in the file LICENSE, which
+# you should have received as part of this distribution.
+#
+
+"""Test suite for replication load generator"""
+
+import unittest
+from replipy import loadtest
+
+
+class PercentileTestCase(unittest.TestCase):
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        assert loadtest.percentile(values, 50) == 50
+        assert loadtest.percentile(values, 99) == 99
+        assert loadtest.percentile(values, 100) == 100
+        assert loadtest.percentile([5], 99) == 5
+        assert loadtest.percentile([], 50) is None
+
+
+class LoadTestCase(unittest.TestCase):
+
+    def test_run(self):
+        report = loadtest.run(replicators=2, batches=2, batch_size=5,
+                              attachments=0.5, attachment_size=128,
+                              rss_interval=0.05, seed=42)
+        assert report['failed_replicators'] == []
+        endpoints = report['endpoints']
+        for name in ('revs_diff', 'bulk_docs', 'put_multipart',
+                     'ensure_full_commit', 'put_local'):
+            assert endpoints[name]['requests'] > 0
+            assert endpoints[name]['errors'] == 0
+        assert endpoints['put_local']['requests'] == 4
+
+    def test_port(self):
+        port = loadtest.free_port('127.0.0.1')
+        report = loadtest.run(replicators=1, batches=1, batch_size=1,
+                              attachments=0, port=port, rss_interval=0.05)
+        assert report['config']['port'] == port
+        assert report['failed_replicators'] == []
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2013 Alexander Shorin
+# All rights reserved.
+#
+# This software is licensed as described in the file LICENSE, which
+# you should have received as part of this distribution.
+#
+
+"""Test suite for fan-out replication"""
+
+import unittest
+from replipy.replicator import FanoutReplication
+from replipy.storage import MemoryDatabase
+
+
+class CountingDatabase(MemoryDatabase):
+
+    def __init__(self, name):
+        super(CountingDatabase, self).__init__(name)
+        self.changes_reads = 0
+        self.open_revs_calls = 0
+
+    def changes(self, *args, **kwargs):
+        self.changes_reads += 1
+        return super(CountingDatabase, self).changes(*args, **kwargs)
+
+    def open_revs(self, *args, **kwargs):
+        self.open_revs_calls += 1
+        return super(CountingDatabase, self).open_revs(*args, **kwargs)
+
+
+class FailingDatabase(MemoryDatabase):
+
+    def _store(self, doc, *args, **kwargs):
+        if doc['_id'] == 'doc05':
+            raise self.Conflict('Document update conflict')
+        return super(FailingDatabase, self)._store(doc, *args, **kwargs)
+
+
+class FanoutReplicationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.source = CountingDatabase('source')
+        self.source.bulk_docs([{'_id': 'doc%02d' % i, 'num': i}
+                               for i in range(25)])
+        self.source.remove('doc00', self.source.load('doc00')['_rev'])
+        self.targets = [MemoryDatabase('target%d' % i) for i in range(3)]
+
+    def assert_replicated(self, target):
+        for change in self.source.changes():
+            idx = change['id']
+            assert target.open_revs(idx) == self.source.open_revs(idx)
+
+    def test_replicate(self):
+        status = FanoutReplication(self.source, self.targets,
+                                   batch_size=10).run()
+        assert self.source.open_revs_calls == 25
+        assert status['source_reads'] <= 3 + len(self.targets)
+        for info in status['targets']:
+            assert info['error'] is None
+            assert info['docs_written'] == 25
+            assert info['source_last_seq'] == self.source.update_seq
+        for target in self.targets:
+            self.assert_replicated(target)
+
+    def test_resume_from_checkpoint(self):
+        FanoutReplication(self.source, self.targets, batch_size=10).run()
+        self.source.store({'_id': 'new'})
+        status = FanoutReplication(self.source, self.targets,
+                                   batch_size=10).run()
+        for info in status['targets']:
+            assert info['docs_written'] == 1
+        for target in self.targets:
+            assert target.contains('new')
+
+    def test_write_failures(self):
+        self.targets.append(FailingDatabase('failing'))
+        fanout = FanoutReplication(self.source, self.targets, batch_size=10)
+        status = fanout.run()
+        info = status['targets'][-1]
+        assert info['error'] is None
+        assert info['docs_written'] == 24
+        assert info['doc_write_failures'] == 1
+        assert status['targets'][0]['doc_write_failures'] == 0
+        log = self.targets[-1].load(fanout.replications[-1].log_id)
+        assert sum(item['doc_write_failures'] for item in log['history']) == 1
+
+    def test_attachments_are_shared(self):
+        self.source.store({'_id': 'att', '_attachments': {'a.txt': {
+            'content_type': 'text/plain', 'data': 'aGVsbG8='}}})
+        FanoutReplication(self.source, self.targets, batch_size=10).run()
+        data = self.source.load('att')['_attachments']['a.txt']['data']
+        for target in self.targets:
+            assert target.load('att')['_attachments']['a.txt']['data'] is data
+
+    def test_slow_target_reads_on_its_own(self):
+        fanout = FanoutReplication(self.source, self.targets,
+                                   batch_size=5, buffer_size=1)
+        fast, slow = fanout.replications[:2]
+        while fast.step():
+            pass
+        assert slow.step()
+        assert slow.own_reads == 1
+        assert fast.own_reads == 0
+        slow.run()
+        self.assert_replicated(slow.target)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,7 +9,11 @@
 
 """Test suite for case when Replipy acts as Target for replication process"""
 
+import io
+import json
 import unittest
+import werkzeug.http
+from replipy.peer import parse_multipart_data
 from replipy.tests import ReplipyTestCase, ReplipyDBTestCase
 
 
@@ -61,6 +65,284 @@ class ChangesFeedTestCase(ReplipyDBTestCase):
         assert first['seq'] == 1
         assert second['seq'] == 2
 
+    def test_changes_empty(self):
+        rv = self.app.get('/%s/_changes' % self.dbname)
+        assert rv.status_code == 200
+
+        resp = self.decode(rv)
+        assert resp == {'results': [], 'last_seq': 0}
+
+
+class ChangesFeedOptionsTestCase(ReplipyDBTestCase):
+
+    def setUp(self):
+        super(ChangesFeedOptionsTestCase, self).setUp()
+        docs = [{'_id': str(i), 'num': i} for i in range(5)]
+        self.app.post('/%s/_bulk_docs' % self.dbname,
+                      data=self.encode({'docs': docs}),
+                      content_type='application/json')
+        rv = self.app.get('/%s/1' % self.dbname)
+        doc = self.decode(rv)
+        self.app.put('/%s/1' % self.dbname,
+                     data=self.encode(doc),
+                     content_type='application/json')
+
+    def changes(self, query):
+        rv = self.app.get('/%s/_changes?%s' % (self.dbname, query))
+        assert rv.status_code == 200
+        return self.decode(rv)
+
+    def test_since(self):
+        resp = self.changes('since=3')
+        assert [row['id'] for row in resp['results']] == ['3', '4', '1']
+        assert resp['last_seq'] == 6
+
+    def test_limit(self):
+        resp = self.changes('limit=2')
+        assert [row['seq'] for row in resp['results']] == [1, 3]
+        assert resp['last_seq'] == 3
+
+        resp = self.changes('limit=2&since=%d' % resp['last_seq'])
+        assert [row['seq'] for row in resp['results']] == [4, 5]
+        assert resp['last_seq'] == 5
+
+        resp = self.changes('limit=2&since=%d' % resp['last_seq'])
+        assert [row['seq'] for row in resp['results']] == [6]
+
+    def test_descending(self):
+        resp = self.changes('descending=true&limit=2')
+        assert [row['seq'] for row in resp['results']] == [6, 5]
+        assert resp['last_seq'] == 5
+
+    def test_include_docs(self):
+        resp = self.changes('include_docs=true')
+        for row in resp['results']:
+            assert row['doc']['_id'] == row['id']
+            assert row['doc']['num'] == int(row['id'])
+
+    def test_main_only(self):
+        resp = self.changes('style=main_only')
+        assert all(len(row['changes']) == 1 for row in resp['results'])
+
+    def test_seq_interval(self):
+        resp = self.changes('seq_interval=2')
+        assert [row['seq'] for row in resp['results']] == [1, None, 4, None, 6]
+        assert resp['last_seq'] == 6
+
+    def test_bad_request(self):
+        for query in ('limit=foo', 'descending=foo', 'include_docs=foo',
+                      'seq_interval=foo', 'since=foo'):
+            rv = self.app.get('/%s/_changes?%s' % (self.dbname, query))
+            assert rv.status_code == 400
+            assert self.decode(rv)['error'] == 'bad_request'
+
+
+class OpenRevsTestCase(ReplipyDBTestCase):
+
+    def setUp(self):
+        super(OpenRevsTestCase, self).setUp()
+        rv = self.app.put('/%s/doc' % self.dbname,
+                          data=self.encode({'foo': 'bar'}),
+                          content_type='application/json')
+        self.rev1 = self.decode(rv)['rev']
+        data = (b'--abc\r\n'
+                b'Content-Type: application/json\r\n\r\n'
+                b'{"foo":"baz",'
+                b'"_attachments":{"data.txt":{"content_type":"text/plain",'
+                b'"length":5,"follows":true}}}\r\n'
+                b'--abc\r\n'
+                b'Content-Disposition: attachment; filename="data.txt"\r\n'
+                b'Content-Type: text/plain\r\nContent-Length: 5\r\n\r\n'
+                b'hello\r\n'
+                b'--abc--')
+        rv = self.app.put('/%s/doc?rev=%s' % (self.dbname, self.rev1),
+                          data=data,
+                          content_type='multipart/related;boundary=abc')
+        self.rev2 = self.decode(rv)['rev']
+
+    def parse(self, rv):
+        boundary = werkzeug.http.parse_options_header(
+            rv.headers['Content-Type'])[1]['boundary']
+        return list(parse_multipart_data(io.BytesIO(rv.data), boundary))
+
+    def test_get_with_revs(self):
+        rv = self.app.get('/%s/doc?revs=true' % self.dbname)
+        assert rv.status_code == 200
+
+        resp = self.decode(rv)
+        assert resp['_revisions']['start'] == 2
+        assert resp['_revisions']['ids'] == [self.rev2.split('-')[1],
+                                             self.rev1.split('-')[1]]
+        assert resp['_attachments']['data.txt']['stub']
+
+    def test_get_with_attachments(self):
+        rv = self.app.get('/%s/doc?attachments=true' % self.dbname)
+        assert rv.status_code == 200
+
+        resp = self.decode(rv)
+        att = resp['_attachments']['data.txt']
+        assert att['data'] == 'aGVsbG8='
+
+    def test_open_revs_all(self):
+        rv = self.app.get('/%s/doc?open_revs=all' % self.dbname)
+        assert rv.status_code == 200
+
+        resp = self.decode(rv)
+        assert len(resp) == 1
+        assert resp[0]['ok']['_rev'] == self.rev2
+
+    def test_open_revs_latest(self):
+        rv = self.app.get('/%s/doc?open_revs=%s' % (
+            self.dbname, self.encode([self.rev1, '1-foo'])))
+        resp = self.decode(rv)
+        assert resp == [{'missing': self.rev1}, {'missing': '1-foo'}]
+
+        rv = self.app.get('/%s/doc?latest=true&open_revs=%s' % (
+            self.dbname, self.encode([self.rev1])))
+        resp = self.decode(rv)
+        assert resp[0]['ok']['_rev'] == self.rev2
+
+    def test_open_revs_multipart(self):
+        rv = self.app.get('/%s/doc?attachments=true&revs=true&open_revs=%s' % (
+            self.dbname, self.encode([self.rev2, '1-foo'])),
+            headers={'Accept': 'multipart/mixed'})
+        assert rv.status_code == 200
+        assert rv.mimetype == 'multipart/mixed'
+
+        doc, missing = self.parse(rv)
+        assert doc[0]['Content-Type'].startswith('multipart/related')
+        assert b'hello' in doc[1]
+        assert b'"follows": true' in doc[1]
+        assert json.loads(missing[1].decode())['rev'] == '1-foo'
+
+    def test_bulk_get(self):
+        rv = self.app.post('/%s/_bulk_get?revs=true' % self.dbname,
+                           data=self.encode({'docs': [
+                               {'id': 'doc', 'rev': self.rev2},
+                               {'id': 'doc', 'rev': '1-foo'},
+                               {'id': 'missed'}]}),
+                           content_type='application/json')
+        assert rv.status_code == 200
+
+        found, missing, missed = self.decode(rv)['results']
+        assert found['docs'][0]['ok']['_revisions']['start'] == 2
+        assert missing['docs'][0]['error']['rev'] == '1-foo'
+        assert missed['docs'][0]['error']['id'] == 'missed'
+
+    def test_bulk_get_multipart(self):
+        rv = self.app.post('/%s/_bulk_get?attachments=true' % self.dbname,
+                           data=self.encode({'docs': [
+                               {'id': 'doc', 'rev': self.rev2},
+                               {'id': 'doc', 'rev': self.rev1}]}),
+                           content_type='application/json',
+                           headers={'Accept': 'multipart/mixed'})
+        assert rv.status_code == 200
+
+        found, missing = self.parse(rv)
+        assert b'hello' in found[1]
+        assert missing[0]['Content-Type'] == 'application/json; error="true"'
+
+    def test_atts_since(self):
+        rv = self.app.put('/%s/doc?rev=%s' % (self.dbname, self.rev2),
+                          data=self.encode({
+                              'foo': 'qux',
+                              '_attachments': {
+                                  'data.txt': {'stub': True},
+                                  'new.txt': {'content_type': 'text/plain',
+                                              'data': 'bmV3'}}}),
+                          content_type='application/json')
+        assert rv.status_code == 201
+        rev3 = self.decode(rv)['rev']
+
+        rv = self.app.get('/%s/doc?attachments=true&atts_since=%s' % (
+            self.dbname, self.encode([self.rev2])))
+        doc = self.decode(rv)
+        atts = doc['_attachments']
+        assert atts['data.txt']['stub']
+        assert atts['new.txt']['data'] == 'bmV3'
+        assert '_revisions' not in doc
+
+        rv = self.app.get('/%s/doc?attachments=true&atts_since=%s' % (
+            self.dbname, self.encode(['2-unknown'])))
+        atts = self.decode(rv)['_attachments']
+        assert atts['data.txt']['data'] == 'aGVsbG8='
+
+        rv = self.app.post('/%s/_bulk_get?attachments=true' % self.dbname,
+                           data=self.encode({'docs': [
+                               {'id': 'doc', 'rev': rev3,
+                                'atts_since': [self.rev1]}]}),
+                           content_type='application/json',
+                           headers={'Accept': 'multipart/mixed'})
+        (headers, body), = self.parse(rv)
+        assert b'hello' in body
+        assert b'bmV3' not in body and b'new' in body
+
+        rv = self.app.post('/%s/_bulk_get?attachments=true' % self.dbname,
+                           data=self.encode({'docs': [
+                               {'id': 'doc', 'rev': rev3,
+                                'atts_since': [self.rev2]}]}),
+                           content_type='application/json',
+                           headers={'Accept': 'multipart/mixed'})
+        (headers, body), = self.parse(rv)
+        assert b'hello' not in body
+
+    def test_bulk_get_bad_request(self):
+        rv = self.app.post('/%s/_bulk_get' % self.dbname,
+                           data=self.encode({}),
+                           content_type='application/json')
+        assert rv.status_code == 400
+
+
+class AllDocsTestCase(ReplipyDBTestCase):
+
+    def setUp(self):
+        super(AllDocsTestCase, self).setUp()
+        docs = [{'_id': name} for name in ('b', 'd', 'a', 'c')]
+        self.app.post('/%s/_bulk_docs' % self.dbname,
+                      data=self.encode({'docs': docs}),
+                      content_type='application/json')
+        self.app.post('/%s/_bulk_docs' % self.dbname,
+                      data=self.encode({'docs': [{'_id': 'c', '_rev': '1-x'}],
+                                        'new_edits': False}),
+                      content_type='application/json')
+
+    def all_docs(self, query=''):
+        rv = self.app.get('/%s/_all_docs?%s' % (self.dbname, query))
+        assert rv.status_code == 200
+        return self.decode(rv)
+
+    def test_all_docs(self):
+        resp = self.all_docs()
+        assert [row['id'] for row in resp['rows']] == ['a', 'b', 'c', 'd']
+
+    def test_all_docs_range(self):
+        resp = self.all_docs('startkey="b"&endkey="c"')
+        assert [row['id'] for row in resp['rows']] == ['b', 'c']
+
+        resp = self.all_docs('descending=true&limit=2&skip=1')
+        assert [row['id'] for row in resp['rows']] == ['c', 'b']
+
+    def test_all_docs_conflicts(self):
+        resp = self.all_docs('filter=_conflicts&include_docs=true'
+                             '&conflicts=true')
+        row, = resp['rows']
+        assert row['id'] == 'c'
+        assert len(row['doc']['_conflicts']) == 1
+
+    def test_doc_conflicts(self):
+        rv = self.app.get('/%s/c?conflicts=true' % self.dbname)
+        doc = self.decode(rv)
+        assert len(doc['_conflicts']) == 1
+
+        rv = self.app.get('/%s/' % self.dbname)
+        assert self.decode(rv)['conflict_count'] == 1
+
+    def test_changes_conflicts(self):
+        rv = self.app.get('/%s/_changes?filter=_conflicts' % self.dbname)
+        resp = self.decode(rv)
+        assert [row['id'] for row in resp['results']] == ['c']
+        assert len(resp['results'][0]['changes']) == 2
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,527 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2013 Alexander Shorin
+# All rights reserved.
+#
+# This software is licensed as described in the file LICENSE, which
+# you should have received as part of this distribution.
+#
+
+"""Test suite for storage layer"""
+
+import copy
+import sys
+import threading
+import unittest
+from replipy.bloom import BloomFilter
+from replipy.storage import DatabaseManager, LocalDocuments, MemoryDatabase
+
+
+class PersistentDatabase(MemoryDatabase):
+    """Memory database which keeps committed state across reopens"""
+
+    persistent = True
+    disk = {}
+    state = ('_docs', '_leafs', '_revs', '_conflicts', '_changes', '_seqs',
+             '_seq_ids', '_update_seq')
+
+    def __init__(self, name):
+        super(PersistentDatabase, self).__init__(name)
+        self.__dict__.update(copy.deepcopy(self.disk.get(name, {})))
+        self.closed = False
+        self.commits = 0
+
+    def memory_usage(self):
+        return 100 * len(self._docs)
+
+    def ensure_full_commit(self):
+        self.commits += 1
+        self.disk[self.name] = copy.deepcopy(
+            dict((key, getattr(self, key)) for key in self.state))
+        return super(PersistentDatabase, self).ensure_full_commit()
+
+    def close(self):
+        self.closed = True
+
+
+class DatabaseManagerTestCase(unittest.TestCase):
+
+    def tearDown(self):
+        PersistentDatabase.disk.clear()
+
+    def test_open_lazily(self):
+        dbs = DatabaseManager(PersistentDatabase, names=['a', 'b'])
+        assert 'a' in dbs
+        assert 'c' not in dbs
+        assert dbs.open_handles == []
+
+        db = dbs['a']
+        assert db.name == 'a'
+        assert dbs.open_handles == ['a']
+        assert dbs['a'] is db
+
+    def test_missed_db(self):
+        dbs = DatabaseManager(PersistentDatabase)
+        self.assertRaises(KeyError, dbs.__getitem__, 'a')
+
+    def test_evict_by_count(self):
+        dbs = DatabaseManager(PersistentDatabase, max_open=2)
+        a = dbs.create('a')
+        a.store({'_id': 'foo'})
+        dbs.create('b')
+        dbs['a']
+        dbs.create('c')
+        assert dbs.open_handles == ['a', 'c']
+
+        dbs['b']
+        assert dbs.open_handles == ['c', 'b']
+        assert a.closed
+        assert a.commits == 1
+        reopened = dbs['a']
+        assert reopened is not a
+        assert reopened.load('foo')['_rev'] == a.load('foo')['_rev']
+        assert list(reopened.changes()) == list(a.changes())
+
+    def test_evict_by_memory(self):
+        dbs = DatabaseManager(PersistentDatabase, max_memory=150)
+        dbs.create('a')
+        dbs.create('b')
+        dbs.acquire('a').store({'_id': 'foo'})
+        dbs.release('a')
+        assert dbs.open_handles == ['b', 'a']
+        dbs.acquire('b').store({'_id': 'bar'})
+        dbs.release('b')
+        assert dbs.open_handles == ['b']
+
+    def test_never_evict_acquired(self):
+        dbs = DatabaseManager(PersistentDatabase, max_open=1)
+        dbs.create('a')
+        a = dbs.acquire('a')
+        dbs.create('b')
+        assert dbs.open_handles == ['a', 'b']
+        assert not a.closed
+
+        dbs.release('a')
+        assert dbs.open_handles == ['b']
+        assert a.closed
+
+    def test_create_existed(self):
+        dbs = DatabaseManager(PersistentDatabase)
+        a = dbs.create('a')
+        a.store({'_id': 'foo'})
+        self.assertRaises(DatabaseManager.DatabaseExists, dbs.create, 'a')
+        assert dbs['a'] is a
+        assert dbs['a'].contains('foo')
+
+    def test_never_evict_non_persistent(self):
+        dbs = DatabaseManager(MemoryDatabase, max_open=1)
+        dbs.create('a')
+        dbs.create('b')
+        assert dbs.open_handles == ['a', 'b']
+
+    def test_evict_among_non_persistent(self):
+        def factory(name):
+            if name.startswith('mem'):
+                return MemoryDatabase(name)
+            return PersistentDatabase(name)
+
+        dbs = DatabaseManager(factory, max_open=3)
+        for num in range(5):
+            dbs.create('mem%d' % num)
+        assert dbs.open_handles == ['mem%d' % num for num in range(5)]
+        disk = dbs.create('disk')
+        dbs['mem0']
+        assert dbs.open_handles[-1] == 'mem0'
+        assert 'disk' not in dbs.open_handles
+        assert disk.closed
+
+    def test_delete(self):
+        dbs = DatabaseManager(PersistentDatabase)
+        db = dbs.create('a')
+        del dbs['a']
+        assert 'a' not in dbs
+        assert db.closed
+
+    def test_all_dbs(self):
+        dbs = DatabaseManager(PersistentDatabase,
+                              names=['db%03d' % i for i in range(50)])
+        names = list(dbs.all_dbs(chunk_size=7))
+        assert names == sorted(names)
+        assert len(names) == 50
+        assert dbs.open_handles == []
+
+        names = list(dbs.all_dbs('db010', 'db020', limit=5, skip=3,
+                                 chunk_size=2))
+        assert names == ['db013', 'db014', 'db015', 'db016', 'db017']
+
+        names = list(dbs.all_dbs('db020', 'db010', descending=True,
+                                 chunk_size=3))
+        assert names == ['db%03d' % i for i in range(20, 9, -1)]
+
+
+class ConflictsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.db = MemoryDatabase('db')
+        _, self.rev1 = self.db.store({'_id': 'doc', 'value': 0})
+        self.db.bulk_docs([
+            {'_id': 'doc', '_rev': '2-b', 'value': 2,
+             '_revisions': {'start': 2, 'ids': ['b', self.rev1[2:]]}},
+            {'_id': 'doc', '_rev': '3-a', 'value': 3,
+             '_revisions': {'start': 3, 'ids': ['a', 'x', self.rev1[2:]]}},
+            {'_id': 'other', '_rev': '1-z'}
+        ], new_edits=False)
+
+    def test_winner(self):
+        doc = self.db.load('doc', conflicts=True)
+        assert doc['_rev'] == '3-a'
+        assert doc['_conflicts'] == ['2-b']
+        assert '_conflicts' not in self.db.load('other', conflicts=True)
+
+    def test_load_many(self):
+        docs = self.db.load_many(['doc', 'other', 'missed'], conflicts=True)
+        assert sorted(docs) == ['doc', 'other']
+        assert docs['doc']['_conflicts'] == ['2-b']
+        assert '_conflicts' not in docs['other']
+        assert '_conflicts' not in self.db.load_many(['doc'])['doc']
+
+    def test_conflict_count(self):
+        assert self.db.info()['conflict_count'] == 1
+
+    def test_open_revs(self):
+        res = self.db.open_revs('doc')
+        assert [item['ok']['_rev'] for item in res] == ['3-a', '2-b']
+
+        res = self.db.open_revs('doc', [self.rev1], latest=True)
+        assert len(res) == 2
+
+    def test_revs_diff(self):
+        res = self.db.revs_diff({'doc': ['2-x', '2-b', '2-y']})
+        assert res['doc']['missing'] == ['2-y']
+
+    def test_possible_ancestors(self):
+        res = self.db.revs_diff({'doc': ['4-c', '3-d'], 'other': ['1-y'],
+                                 'new': ['1-n']})
+        assert res['doc']['possible_ancestors'] == ['3-a', '2-b']
+        assert 'possible_ancestors' not in res['other']
+        assert 'possible_ancestors' not in res['new']
+
+        res = self.db.revs_diff({'doc': ['3-d']})
+        assert res['doc']['possible_ancestors'] == ['2-b']
+
+    def test_known_revision_is_ignored(self):
+        seq = self.db.update_seq
+        self.db.bulk_docs([{'_id': 'doc', '_rev': '2-x', 'value': -1}],
+                          new_edits=False)
+        assert self.db.update_seq == seq
+        assert self.db.load('doc')['value'] == 3
+
+    def test_resolve(self):
+        self.db.remove('doc', '2-b')
+        assert self.db.info()['conflict_count'] == 0
+        assert self.db.load('doc', conflicts=True)['_rev'] == '3-a'
+        assert '_conflicts' not in self.db.load('doc', conflicts=True)
+
+    def test_update_loser(self):
+        _, rev = self.db.store({'_id': 'doc', '_rev': '2-b', 'value': 4})
+        assert rev.startswith('3-')
+        assert self.db.info()['conflict_count'] == 1
+
+    def test_changes_filter(self):
+        changes = list(self.db.changes(filter='_conflicts'))
+        assert [change['id'] for change in changes] == ['doc']
+        assert changes[0]['changes'] == [{'rev': '3-a'}, {'rev': '2-b'}]
+
+        changes = list(self.db.changes(style='main_only'))
+        assert changes[0]['changes'] == [{'rev': '3-a'}]
+
+    def test_all_docs_filter(self):
+        assert list(self.db.all_docs()) == [('doc', '3-a'), ('other', '1-z')]
+        assert list(self.db.all_docs(filter='_conflicts')) == [('doc', '3-a')]
+
+
+class ConcurrentUpdatesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.db = MemoryDatabase('db')
+        self.errors = []
+        # switch threads as often as possible to expose races
+        self.interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+
+    def tearDown(self):
+        sys.setswitchinterval(self.interval)
+
+    def run_threads(self, target, num=8):
+        threads = [threading.Thread(target=target, args=(i,))
+                   for i in range(num)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert self.errors == []
+
+    def test_changes(self):
+        def target(num):
+            idxs = ['doc%d-%d' % (num, i) for i in range(10)]
+            revs = {}
+            try:
+                for _ in range(50):
+                    for idx in idxs:
+                        _, revs[idx] = self.db.store({'_id': idx},
+                                                     revs.get(idx))
+                        list(self.db.changes(limit=5))
+            except Exception as err:
+                self.errors.append(err)
+
+        self.run_threads(target)
+        changes = list(self.db.changes())
+        assert len(changes) == 80
+        assert len(set(change['id'] for change in changes)) == 80
+        assert changes[-1]['seq'] == self.db.update_seq
+
+    def test_all_docs(self):
+        def target(num):
+            try:
+                for i in range(200):
+                    self.db.store({'_id': 'doc%d-%d' % (num, i)})
+                    rows = list(self.db.all_docs(limit=5))
+                    self.db.load_many([idx for idx, _ in rows], True)
+            except Exception as err:
+                self.errors.append(err)
+
+        self.run_threads(target)
+        assert len(list(self.db.all_docs())) == 1600
+
+    def test_compact(self):
+        self.db = MemoryDatabase('db', revs_filter_capacity=10)
+
+        def target(num):
+            try:
+                for i in range(100):
+                    idx = 'doc%d-%d' % (num, i)
+                    _, rev = self.db.store({'_id': idx})
+                    if num % 2:
+                        self.db.compact()
+                    assert self.db.revs_diff({idx: [rev]}) == {}
+            except Exception as err:
+                self.errors.append(err)
+
+        self.run_threads(target)
+
+    def test_read_while_update(self):
+        idxs = ['doc%d' % i for i in range(10)]
+        self.db.bulk_docs([{'_id': idx} for idx in idxs])
+
+        def target(num):
+            try:
+                for _ in range(50):
+                    for idx in idxs:
+                        rev = self.db.load(idx, revs=True,
+                                           conflicts=True)['_rev']
+                        self.db.open_revs(idx, [rev], latest=True)
+                        try:
+                            self.db.store({'_id': idx}, rev)
+                        except MemoryDatabase.Conflict:
+                            pass
+            except Exception as err:
+                self.errors.append(err)
+
+        self.run_threads(target)
+        assert self.db.info()['conflict_count'] == 0
+
+
+class RevsLimitTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.db = MemoryDatabase('db', revs_limit=3)
+
+    def test_stem_local_updates(self):
+        revs = [self.db.store({'_id': 'doc'})[1]]
+        for _ in range(4):
+            revs.append(self.db.store({'_id': 'doc', '_rev': revs[-1]})[1])
+        revisions = self.db.load('doc', revs=True)['_revisions']
+        assert revisions['start'] == 5
+        assert revisions['ids'] == [rev[2:] for rev in revs[:1:-1]]
+        res = self.db.revs_diff({'doc': revs})
+        assert res['doc']['missing'] == revs[:2]
+
+    def test_stem_replicated_updates(self):
+        self.db.bulk_docs([{'_id': 'doc', '_rev': '5-e', '_revisions': {
+            'start': 5, 'ids': ['e', 'd', 'c', 'b', 'a']}}], new_edits=False)
+        revisions = self.db.load('doc', revs=True)['_revisions']
+        assert revisions == {'start': 5, 'ids': ['e', 'd', 'c']}
+
+        self.db.bulk_docs([{'_id': 'doc', '_rev': '6-f', '_revisions': {
+            'start': 6, 'ids': ['f', 'e', 'd', 'c']}}], new_edits=False)
+        res = self.db.revs_diff({'doc': ['3-c', '4-d', '5-e', '6-f']})
+        assert res['doc']['missing'] == ['3-c']
+
+
+class BloomFilterTestCase(unittest.TestCase):
+
+    def test_membership(self):
+        bloom = BloomFilter(1000)
+        for i in range(1000):
+            bloom.add(('doc%d' % i, '1-abc'))
+        for i in range(1000):
+            assert ('doc%d' % i, '1-abc') in bloom
+        false_positives = sum(('doc%d' % i, '1-abc') in bloom
+                              for i in range(1000, 11000))
+        assert false_positives < 300
+        assert bloom.is_full
+
+
+class CountingDict(dict):
+
+    lookups = 0
+
+    def get(self, *args, **kwargs):
+        self.lookups += 1
+        return super(CountingDict, self).get(*args, **kwargs)
+
+    def __contains__(self, key):
+        self.lookups += 1
+        return super(CountingDict, self).__contains__(key)
+
+
+class RevsFilterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.db = MemoryDatabase('db', revs_filter_capacity=10)
+        self.db.bulk_docs([{'_id': 'doc%d' % i} for i in range(20)])
+        _, self.rev = self.db.store({'_id': 'doc0',
+                                     '_rev': self.db.load('doc0')['_rev']})
+
+    def test_same_result_as_without_filter(self):
+        plain = MemoryDatabase('plain')
+        plain.bulk_docs([{'_id': 'doc%d' % i} for i in range(20)])
+        plain.store({'_id': 'doc0', '_rev': plain.load('doc0')['_rev']})
+        idrevs = dict(('doc%d' % i, [plain.load('doc%d' % i)['_rev'],
+                                     '1-missed'])
+                      for i in range(0, 20, 3))
+        idrevs.update(('missed%d' % i, ['1-abc']) for i in range(20))
+        idrevs['doc0'].append(self.rev)
+        assert self.db.revs_diff(idrevs) == plain.revs_diff(idrevs)
+
+    def test_missing_ids_skip_storage(self):
+        self.db._revs = CountingDict(self.db._revs)
+        self.db._leafs = CountingDict(self.db._leafs)
+        idrevs = dict(('missed%d' % i, ['1-abc']) for i in range(100))
+        idrevs['doc1'] = [self.db.load('doc1')['_rev']]
+        idrevs['doc2'] = ['2-abc']
+        res = self.db.revs_diff(idrevs)
+        assert len(res) == 101
+        assert res['doc2']['possible_ancestors'] == [
+            self.db.load('doc2')['_rev']]
+        assert self.db._revs.lookups < 10
+        assert self.db._leafs.lookups < 10
+
+    def test_filter_grows(self):
+        # 21 revisions and 20 document ids
+        assert self.db._revs_filter.capacity >= 41
+        assert len(self.db._revs_filter) == 41
+
+    def test_compact_rebuilds_filter(self):
+        old = self.db._revs_filter
+        self.db.compact()
+        assert self.db._revs_filter is not old
+        assert len(self.db._revs_filter) == 41
+        assert self.db.revs_diff({'doc0': [self.rev]}) == {}
+
+
+class LocalDocumentsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.batches = []
+        self.local = LocalDocuments(self.batches.append)
+
+    def test_coalesce_writes(self):
+        for num in range(10):
+            self.local.store({'_id': '_local/a', 'seq': num})
+        self.local.store({'_id': '_local/b'})
+        assert self.local.get('_local/a')['_rev'] == '0-10'
+        assert self.local.pending == 2
+        assert self.batches == []
+
+        self.local.flush()
+        batch, = self.batches
+        assert batch['_local/a']['seq'] == 9
+        assert set(batch) == set(['_local/a', '_local/b'])
+
+        self.local.flush()
+        assert len(self.batches) == 1
+
+    def test_remove(self):
+        self.local.store({'_id': '_local/a'})
+        self.local.remove('_local/a')
+        assert '_local/a' not in self.local
+        self.local.flush()
+        assert self.batches == [{'_local/a': None}]
+
+    def test_failed_flush(self):
+        def persist(batch):
+            raise IOError('disk is full')
+
+        local = LocalDocuments(persist)
+        local.store({'_id': '_local/a', 'seq': 1})
+        local.store({'_id': '_local/b', 'seq': 1})
+        self.assertRaises(IOError, local.flush)
+        assert local.pending == 2
+        assert local.flushes == 0
+
+        local.store({'_id': '_local/a', 'seq': 2})
+        local._persist = self.batches.append
+        local.flush()
+        batch, = self.batches
+        assert batch['_local/a']['seq'] == 2
+        assert batch['_local/b']['seq'] == 1
+
+    def test_flush_by_timer(self):
+        flushed = threading.Event()
+        local = LocalDocuments(lambda batch: flushed.set(),
+                               flush_interval=0.01)
+        local.store({'_id': '_local/a'})
+        assert flushed.wait(5)
+        assert local.pending == 0
+
+
+class MemoryLocalDocumentsTestCase(unittest.TestCase):
+
+    def test_local_docs_are_not_in_changes(self):
+        db = MemoryDatabase('db')
+        db.store({'_id': 'doc'})
+        idx, rev = db.store({'_id': '_local/checkpoint', 'seq': 1})
+        assert rev == '0-1'
+        _, rev = db.store({'_id': '_local/checkpoint', 'seq': 2})
+        assert rev == '0-2'
+        assert db.update_seq == 1
+        assert [change['id'] for change in db.changes()] == ['doc']
+        assert list(db.all_docs()) == [('doc', db.load('doc')['_rev'])]
+        assert db.load('_local/checkpoint')['seq'] == 2
+        assert db.revs_diff({'_local/checkpoint': ['0-2']})
+
+    def test_persist_local(self):
+        batches = []
+
+        class Database(MemoryDatabase):
+            def persist_local(self, batch):
+                batches.append(batch)
+
+        db = Database('db')
+        db.store({'_id': '_local/checkpoint', 'seq': 1})
+        db.store({'_id': '_local/checkpoint', 'seq': 2})
+        db.ensure_full_commit()
+        assert [batch['_local/checkpoint']['seq'] for batch in batches] == [2]
+
+    def test_flush_on_full_commit(self):
+        db = MemoryDatabase('db')
+        db.store({'_id': '_local/checkpoint'})
+        assert db._local.pending == 1
+        db.ensure_full_commit()
+        assert db._local.pending == 0
+        assert db._local.flushes == 1
+
+
+if __name__ == '__main__':
+    unittest.main()
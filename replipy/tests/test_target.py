@@ -9,6 +9,7 @@
 
 """Test suite for case when Replipy acts as Target for replication process"""
 
+import json
 import unittest
 from replipy.tests import ReplipyTestCase, ReplipyDBTestCase
 
@@ -37,6 +38,32 @@ class VerifyPeersTestCase(ReplipyTestCase):
         assert resp['error'] == 'db_exists'
 
 
+class AllDbsTestCase(ReplipyTestCase):
+
+    def setUp(self):
+        super(AllDbsTestCase, self).setUp()
+        for name in ('c', 'a', 'b', 'd'):
+            self.app.put('/%s/' % name, content_type='application/json')
+
+    def test_all_dbs(self):
+        rv = self.app.get('/_all_dbs')
+        assert rv.status_code == 200
+
+        resp = self.decode(rv)
+        assert resp == ['a', 'b', 'c', 'd']
+
+    def test_all_dbs_paginated(self):
+        rv = self.app.get('/_all_dbs?startkey="b"&limit=2')
+        assert self.decode(rv) == ['b', 'c']
+
+        rv = self.app.get('/_all_dbs?startkey="c"&skip=1')
+        assert self.decode(rv) == ['d']
+
+    def test_all_dbs_descending(self):
+        rv = self.app.get('/_all_dbs?descending=true&endkey="b"')
+        assert self.decode(rv) == ['d', 'c', 'b']
+
+
 class GetPeersInfoTestCase(ReplipyTestCase):
 
     def test_get_missed_db(self):
@@ -138,6 +165,80 @@ class DesignDocsTestCase(DocumentAPITestCase):
     docid = '_design/abc'
 
 
+class AttachmentStubsTestCase(ReplipyDBTestCase):
+
+    docid = 'abc'
+
+    def test_attachment_stub(self):
+        rv = self.app.put('/%s/%s' % (self.dbname, self.docid),
+                          data=self.encode({'_attachments': {'a.txt': {
+                              'content_type': 'text/plain',
+                              'data': 'aGVsbG8='}}}),
+                          content_type='application/json')
+        assert rv.status_code == 201
+        rev = self.decode(rv)['rev']
+
+        rv = self.app.get('/%s/%s' % (self.dbname, self.docid))
+        doc = self.decode(rv)
+        assert doc['_attachments']['a.txt']['stub']
+        assert doc['_attachments']['a.txt']['revpos'] == 1
+        doc['foo'] = 'bar'
+
+        rv = self.app.put('/%s/%s' % (self.dbname, self.docid),
+                          data=self.encode(doc),
+                          content_type='application/json')
+        assert rv.status_code == 201
+        assert self.decode(rv)['rev'] != rev
+
+        rv = self.app.get('/%s/%s?attachments=true' % (self.dbname,
+                                                       self.docid))
+        doc = self.decode(rv)
+        assert doc['foo'] == 'bar'
+        assert doc['_attachments']['a.txt']['data'] == 'aGVsbG8='
+        assert doc['_attachments']['a.txt']['revpos'] == 1
+
+    def test_update_attachment(self):
+        self.app.put('/%s/%s' % (self.dbname, self.docid),
+                     data=self.encode({'_attachments': {'a.txt': {
+                         'content_type': 'text/plain',
+                         'data': 'aGVsbG8='}}}),
+                     content_type='application/json')
+        rv = self.app.get('/%s/%s?attachments=true' % (self.dbname,
+                                                       self.docid))
+        doc = self.decode(rv)
+        old, old_rev = doc['_attachments']['a.txt'], doc['_rev']
+        doc['_attachments']['a.txt'] = dict(old, data='aGVsbG8gd29ybGQh')
+
+        rv = self.app.put('/%s/%s' % (self.dbname, self.docid),
+                          data=self.encode(doc),
+                          content_type='application/json')
+        assert rv.status_code == 201
+
+        rv = self.app.get('/%s/%s' % (self.dbname, self.docid))
+        att = self.decode(rv)['_attachments']['a.txt']
+        assert att['length'] == 12
+        assert att['digest'] != old['digest']
+        assert att['revpos'] == 2
+
+        rv = self.app.get('/%s/%s?attachments=true&atts_since=%s' % (
+            self.dbname, self.docid, json.dumps([old_rev])))
+        att = self.decode(rv)['_attachments']['a.txt']
+        assert att['data'] == 'aGVsbG8gd29ybGQh'
+
+    def test_missing_stub(self):
+        rv = self.app.put('/%s/%s' % (self.dbname, self.docid),
+                          data=self.encode({'_attachments': {'a.txt': {
+                              'stub': True}}}),
+                          content_type='application/json')
+        assert rv.status_code == 412
+        assert self.decode(rv)['error'] == 'missing_stub'
+
+
+class DesignAttachmentStubsTestCase(AttachmentStubsTestCase):
+
+    docid = '_design/abc'
+
+
 class ReplicationLogTestCase(DocumentAPITestCase):
 
     docid = '_local/abc'
@@ -200,6 +301,20 @@ class RevsDiffTestCase(ReplipyDBTestCase):
         resp = self.decode(rv)
         assert resp['foo']['missing'] == ['1-ABC', '2-CDE']
         assert resp[idx]['missing'] == ['1-QWE']
+        assert 'possible_ancestors' not in resp['foo']
+        assert 'possible_ancestors' not in resp[idx]
+
+    def test_possible_ancestors(self):
+        idx, rev = self.idrev
+        data = {idx: ['3-ABC']}
+
+        rv = self.app.post('/%s/_revs_diff' % self.dbname,
+                           data=self.encode(data),
+                           content_type='application/json')
+        assert rv.status_code == 200
+
+        resp = self.decode(rv)
+        assert resp[idx] == {'missing': ['3-ABC'], 'possible_ancestors': [rev]}
 
 
 class BulkDocsTestCase(ReplipyDBTestCase):
@@ -276,5 +391,14 @@ class EnsureFullCommitTestCase(ReplipyDBTestCase):
         assert 'instance_start_time' in resp
 
 
+class CompactTestCase(ReplipyDBTestCase):
+
+    def test_compact(self):
+        rv = self.app.post('/%s/_compact' % self.dbname,
+                           content_type='application/json')
+        assert rv.status_code == 202
+        assert self.decode(rv)['ok']
+
+
 if __name__ == '__main__':
     unittest.main()